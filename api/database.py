@@ -1,5 +1,7 @@
 """Модели базы данных"""
 
+from typing import Any, Optional
+
 from sqlalchemy import (
     create_engine,
     Column,
@@ -9,9 +11,9 @@ from sqlalchemy import (
     ForeignKey,
     Index,
 )
-from sqlalchemy import event
+from sqlalchemy import event, inspect, text
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import QueuePool
 from config.settings import settings
 
 Base = declarative_base()
@@ -31,10 +33,18 @@ class Key(Base):  # type: ignore
     created_at = Column(BigInteger, nullable=False)
     is_active = Column(Integer, default=1)
     last_used_at = Column(BigInteger, nullable=True)
+    # Идентификатор пользователя в Xray (stats/adu/rmu): user_{id}_{uuid[:8]}.
+    # Заполняется сразу после INSERT (id известен только после flush).
+    email = Column(String, unique=True, index=True, nullable=True)
 
-    # Связь с статистикой трафика
+    # Связь с статистикой трафика; lazy="raise" — загрузка только явной опцией
+    # запроса (selectinload/joinedload), без скрытых SELECT на каждый ключ
     traffic_stats = relationship(
-        "TrafficStats", back_populates="key", cascade="all, delete-orphan"
+        "TrafficStats",
+        back_populates="key",
+        cascade="all, delete-orphan",
+        lazy="raise",
+        passive_deletes=True,
     )
 
 
@@ -44,7 +54,7 @@ class TrafficStats(Base):  # type: ignore
     __tablename__ = "traffic_stats"
 
     id = Column(Integer, primary_key=True, index=True)
-    key_id = Column(Integer, ForeignKey("keys.id"), nullable=False, index=True)
+    key_id = Column(Integer, ForeignKey("keys.id", ondelete="CASCADE"), nullable=False)
     upload = Column(BigInteger, default=0)
     download = Column(BigInteger, default=0)
     updated_at = Column(BigInteger, nullable=False)
@@ -52,8 +62,12 @@ class TrafficStats(Base):  # type: ignore
     # Связь с ключом
     key = relationship("Key", back_populates="traffic_stats")
 
-    # Индекс для быстрого поиска по key_id
-    __table_args__ = (Index("idx_key_id", "key_id"),)
+    # Покрывающий индекс: чтение статистики по key_id без обращения к таблице;
+    # уникальный индекс по key_id нужен для INSERT ... ON CONFLICT(key_id)
+    __table_args__ = (
+        Index("idx_traffic_covering", "key_id", "updated_at", "upload", "download"),
+        Index("uq_traffic_stats_key_id", "key_id", unique=True),
+    )
 
 
 # Создание движка базы данных
@@ -67,15 +81,21 @@ if db_url.startswith("sqlite:///"):
     db_path.parent.mkdir(parents=True, exist_ok=True)
 
 connect_args = {}
-engine_kwargs = {}
+engine_kwargs: dict[str, Any] = {
+    "pool_size": settings.db_pool_size,
+    "max_overflow": settings.db_max_overflow,
+    "pool_pre_ping": True,
+    "pool_recycle": settings.db_pool_recycle_s,
+}
 
 if "sqlite" in db_url:
     # SQLite под нагрузкой легко уходит в блокировки/ожидания. Нам важно:
     # - включить busy timeout
     # - включить WAL для конкурентных read/write
-    # - не упираться в лимиты QueuePool при длинных запросах
+    # - переиспользовать соединения (без open/close файла БД на каждый запрос);
+    #   при исчерпании пула SATimeoutError → 503 (см. api.errors)
     connect_args = {"check_same_thread": False, "timeout": 30}
-    engine_kwargs = {"poolclass": NullPool}
+    engine_kwargs["poolclass"] = QueuePool
 
 engine = create_engine(db_url, connect_args=connect_args, **engine_kwargs)
 
@@ -91,6 +111,8 @@ if "sqlite" in db_url:
             cursor.execute("PRAGMA temp_store=MEMORY;")
             cursor.execute("PRAGMA foreign_keys=ON;")
             cursor.execute("PRAGMA busy_timeout=5000;")
+            # ~20 MiB page cache на соединение (отрицательное значение — в KiB)
+            cursor.execute("PRAGMA cache_size=-20000;")
         finally:
             cursor.close()
 
@@ -99,9 +121,66 @@ if "sqlite" in db_url:
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
+def xray_email(key_id: int, uuid: str) -> str:
+    """Email пользователя в Xray для ключа (хранится в Key.email)."""
+    return f"user_{key_id}_{uuid[:8]}"
+
+
+def _migrate_key_email() -> None:
+    """Добавить keys.email в существующую БД и заполнить для старых строк."""
+    columns = {c["name"] for c in inspect(engine).get_columns("keys")}
+    with engine.begin() as conn:
+        if "email" not in columns:
+            conn.execute(text("ALTER TABLE keys ADD COLUMN email VARCHAR"))
+        conn.execute(
+            text(
+                "UPDATE keys SET email = 'user_' || id || '_' || substr(uuid, 1, 8) "
+                "WHERE email IS NULL"
+            )
+        )
+
+
+def _dedupe_traffic_stats() -> None:
+    """Убрать дубли traffic_stats по key_id перед созданием уникального индекса."""
+    indexes = {i["name"] for i in inspect(engine).get_indexes("traffic_stats")}
+    if "uq_traffic_stats_key_id" in indexes:
+        return
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "DELETE FROM traffic_stats WHERE id NOT IN "
+                "(SELECT MAX(id) FROM traffic_stats GROUP BY key_id)"
+            )
+        )
+
+
+# Версия схемы в PRAGMA user_version; увеличивать при изменении таблиц/индексов
+SCHEMA_VERSION = 1
+
+
+def _schema_version() -> Optional[int]:
+    """PRAGMA user_version для SQLite, None для остальных БД."""
+    if engine.dialect.name != "sqlite":
+        return None
+    with engine.connect() as conn:
+        return conn.execute(text("PRAGMA user_version")).scalar()
+
+
 def init_db():
     """Инициализация базы данных"""
+    # Схема уже актуальна — пропускаем create_all и миграции (тёплый старт)
+    if _schema_version() == SCHEMA_VERSION:
+        return
     Base.metadata.create_all(bind=engine)
+    _migrate_key_email()
+    _dedupe_traffic_stats()
+    # create_all не добавляет индексы в уже существующие таблицы
+    for table in (Key.__table__, TrafficStats.__table__):
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as conn:
+            conn.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
 
 
 def get_db():
@@ -4,10 +4,15 @@ from __future__ import annotations
 
 import logging
 
-from fastapi import HTTPException, status
+from fastapi import HTTPException, Request, status
+from fastapi.responses import JSONResponse
 from typing import TYPE_CHECKING
 
-from sqlalchemy.exc import IntegrityError, TimeoutError as SATimeoutError
+from sqlalchemy.exc import (
+    IntegrityError,
+    SQLAlchemyError,
+    TimeoutError as SATimeoutError,
+)
 
 if TYPE_CHECKING:
     from sqlalchemy.orm import Session
@@ -48,3 +53,39 @@ def raise_http_for_db_error(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         detail=f"{default_detail}: {str(e)}",
     ) from e
+
+
+async def sqlalchemy_error_handler(
+    request: Request, exc: SQLAlchemyError
+) -> JSONResponse:
+    """
+    Глобальный обработчик ошибок БД для эндпоинтов без собственного try/except.
+
+    Откат сессии не нужен: get_db() закрывает её после ответа.
+    """
+    operation = f"{request.method} {request.url.path}"
+    if isinstance(exc, SATimeoutError):
+        logger.error(f"[DB_TIMEOUT] {operation}: {exc}")
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content={"detail": "Database temporarily unavailable. Please retry."},
+        )
+    logger.error(f"[DB_ERROR] {operation}: {exc}")
+    return JSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content={"detail": "Database error"},
+    )
+
+
+async def generic_error_handler(request: Request, exc: Exception) -> JSONResponse:
+    """
+    Последний рубеж для непойманных исключений: лог с traceback и JSON
+    {"detail": ...} вместо голого текста 500 от Starlette.
+    """
+    logger.error(
+        f"[UNHANDLED] {request.method} {request.url.path}: {exc}", exc_info=exc
+    )
+    return JSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content={"detail": "Internal server error"},
+    )
@@ -11,26 +11,46 @@ from fastapi import (
 )
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, JSONResponse, Response
+from fastapi.responses import (
+    RedirectResponse,
+    JSONResponse,
+    ORJSONResponse,
+    Response,
+)
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
+from sqlalchemy import Row, delete, insert, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
-from typing import Any, List, Optional
+from typing import Any, List, NamedTuple, Optional, Sequence
 import time
 import logging
 import logging.handlers
 import asyncio
+import atexit
+import fcntl
 import os
-import secrets
+import queue
+import tempfile
+import threading
+import hmac
 import base64
 import json
+import orjson
 from contextlib import asynccontextmanager
 from datetime import datetime
 from pathlib import Path
 from zoneinfo import ZoneInfo
 
 import api.database as db_module
-from api.database import get_db, Key, TrafficStats, init_db
-from api.errors import raise_http_for_db_error
+from api.database import get_db, Key, TrafficStats, init_db, xray_email
+from api.errors import (
+    generic_error_handler,
+    raise_http_for_db_error,
+    sqlalchemy_error_handler,
+)
 from api.models import (
     KeyCreate,
     KeyResponse,
@@ -40,6 +60,7 @@ from api.models import (
     KeyLinksResponse,
     KeyLinkProfile,
     KeyListResponse,
+    KeyWithTrafficListResponse,
     TrafficResetResponse,
     XraySyncStartResponse,
     XraySyncStatusResponse,
@@ -50,7 +71,6 @@ from api.xray_config import XrayConfigManager
 from api.task_queue import config_task_queue, TaskType
 from api.utils import (
     generate_uuid,
-    generate_short_id,
     build_vless_link,
     build_vless_link_with_transport,
     build_trojan_reality_link,
@@ -59,7 +79,6 @@ from api.utils import (
     build_client_config,
     build_happ_singbox_config,
     build_happ_xray_client_config,
-    build_auto_subscription_links,
     build_auto_singbox_subscription_config,
     _server_address_for_links,
 )
@@ -69,11 +88,276 @@ from config.settings import settings
 traffic_cache: dict[
     int, tuple[int, int, int, int]
 ] = {}  # key_id -> (upload, download, cached_at, updated_at)
+
+
+class KeyRow(NamedTuple):
+    """Лёгкая копия строки keys (без ORM identity map / инструментирования)."""
+
+    id: int
+    uuid: str
+    short_id: str
+    name: Optional[str]
+    created_at: int
+    is_active: int
+    email: str
+
+
+# Кэш строк ключей: key_id -> (row, cached_at). Ключи не меняются до удаления,
+# поэтому инвалидируем только при delete; другие воркеры узнают об этом
+# через общую метку key_cache_stamp_file (см. _sync_key_cache_stamp).
+key_cache: dict[int, tuple[KeyRow, float]] = {}
+# UUID → id для поиска по UUID через key_cache (только для ключей, лежащих в кэше)
+key_uuid_index: dict[str, int] = {}
+# Готовое JSON-тело GET /api/keys (единственная запись "all"); сбрасывается при create/delete
+key_list_cache: dict[str, tuple[bytes, float]] = {}
+# Все изменения key_cache / key_uuid_index / key_list_cache — под этим замком:
+# read-эндпоинты работают в threadpool. Чтение dict.get замка не требует
+_key_cache_lock = threading.Lock()
+# Счётчик инвалидаций (create/delete). Читатель запоминает его до SELECT и
+# кладёт результат в кэш, только если счётчик не изменился: иначе ответ,
+# прочитанный до чужого commit, мог бы пережить очистку кэша
+_key_cache_generation = 0
+# Последняя прочитанная метка key_cache_stamp_file (общая для uvicorn --workers N)
+_key_cache_stamp: Optional[bytes] = None
+
+
+def _read_key_cache_stamp() -> Optional[bytes]:
+    """Текущая метка инвалидации из файла (None, если файла ещё нет)."""
+    try:
+        fd = os.open(settings.key_cache_stamp_file, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        return os.read(fd, 64)
+    finally:
+        os.close(fd)
+
+
+def _clear_key_caches_locked(stamp: Optional[bytes]) -> None:
+    """
+    Сбросить кэши ключей и traffic_cache процесса и запомнить метку
+    (под _key_cache_lock).
+    """
+    global _key_cache_generation, _key_cache_stamp
+    key_cache.clear()
+    key_uuid_index.clear()
+    key_list_cache.clear()
+    # Чужой /reset обнуляет счётчики: кэш трафика до него устарел
+    traffic_cache.clear()
+    _key_cache_generation += 1
+    _key_cache_stamp = stamp
+
+
+def _sync_key_cache_stamp() -> None:
+    """
+    Сбросить кэши ключей, если другой воркер сменил метку инвалидации.
+    Вызывается перед каждым чтением из кэша: один open/read без SELECT.
+    """
+    stamp = _read_key_cache_stamp()
+    if stamp == _key_cache_stamp:
+        return
+    with _key_cache_lock:
+        if stamp != _key_cache_stamp:
+            _clear_key_caches_locked(stamp)
+
+
+def _publish_key_cache_stamp() -> None:
+    """
+    Записать новую метку после create/delete/reset трафика (после commit).
+
+    Под flock: сначала учитываем чужую метку (иначе её инвалидация потерялась
+    бы при перезаписи), затем атомарно заменяем файл своей.
+    """
+    global _key_cache_stamp
+    path = settings.key_cache_stamp_file
+    try:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            _sync_key_cache_stamp()
+            stamp = os.urandom(16).hex().encode()
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(path) or ".", prefix=".key_cache_stamp."
+            )
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(stamp)
+            os.replace(tmp_path, path)
+            with _key_cache_lock:
+                _key_cache_stamp = stamp
+    except OSError as e:
+        logger.warning(
+            f"⚠️  Failed to publish key cache stamp {path}: {e}. "
+            f"Other workers will see the change only after key_cache_ttl_s"
+        )
+
+
+_KEY_ROW_COLUMNS = (
+    Key.id,
+    Key.uuid,
+    Key.short_id,
+    Key.name,
+    Key.created_at,
+    Key.is_active,
+    Key.email,
+)
+
+
+def _cache_key_row(
+    key_row: KeyRow, now: float, generation: Optional[int] = None
+) -> None:
+    """
+    Положить строку ключа в key_cache и индекс UUID → id.
+
+    generation — значение _key_cache_generation до SELECT: если с тех пор
+    была инвалидация (например, удаление этого ключа), строку не кэшируем.
+    """
+    with _key_cache_lock:
+        if generation is not None and generation != _key_cache_generation:
+            return
+        if (
+            key_row.id not in key_cache
+            and len(key_cache) >= settings.key_cache_max_size
+        ):
+            # dict сохраняет порядок вставки — вытесняем самую старую запись
+            evicted = key_cache.pop(next(iter(key_cache)))
+            key_uuid_index.pop(evicted[0].uuid, None)
+        key_cache[key_row.id] = (key_row, now)
+        key_uuid_index[key_row.uuid] = key_row.id
+
+
+def _cached_key_row(key_id: int, now: float) -> Optional[KeyRow]:
+    """Строка ключа из key_cache, если запись ещё не устарела."""
+    _sync_key_cache_stamp()
+    cached = key_cache.get(key_id)
+    if cached and (now - cached[1]) < settings.key_cache_ttl_s:
+        return cached[0]
+    return None
+
+
+def _cached_key_row_by_uuid(uuid_value: str, now: float) -> Optional[KeyRow]:
+    """Строка ключа из key_cache через индекс UUID → id."""
+    key_id = key_uuid_index.get(uuid_value)
+    if key_id is None:
+        return None
+    key_row = _cached_key_row(key_id, now)
+    if key_row is not None and key_row.uuid == uuid_value:
+        return key_row
+    return None
+
+
+def _load_key_row(db: Session, key_id: int) -> Optional[KeyRow]:
+    """Строка ключа по id: сначала из key_cache, иначе Core select() без ORM."""
+    now = time.monotonic()
+    cached = _cached_key_row(key_id, now)
+    if cached is not None:
+        return cached
+
+    generation = _key_cache_generation
+    row = db.execute(select(*_KEY_ROW_COLUMNS).where(Key.id == key_id)).first()
+    if row is None:
+        with _key_cache_lock:
+            key_cache.pop(key_id, None)
+        return None
+
+    key_row = KeyRow(*row)
+    _cache_key_row(key_row, now, generation)
+    return key_row
+
+
+def _load_key_row_by_uuid(db: Session, uuid_value: str) -> Optional[KeyRow]:
+    """Строка ключа по UUID: через индекс UUID → id в key_cache, иначе Core select()."""
+    now = time.monotonic()
+    cached = _cached_key_row_by_uuid(uuid_value, now)
+    if cached is not None:
+        return cached
+
+    generation = _key_cache_generation
+    row = db.execute(select(*_KEY_ROW_COLUMNS).where(Key.uuid == uuid_value)).first()
+    if row is None:
+        with _key_cache_lock:
+            key_uuid_index.pop(uuid_value, None)
+        return None
+
+    key_row = KeyRow(*row)
+    _cache_key_row(key_row, now, generation)
+    return key_row
+
+
+async def _load_key_row_async(db: Session, key_id: int) -> Optional[KeyRow]:
+    """_load_key_row для async-эндпоинтов: промах кэша читает БД в threadpool."""
+    cached = _cached_key_row(key_id, time.monotonic())
+    if cached is not None:
+        return cached
+    return await run_in_threadpool(_load_key_row, db, key_id)
+
+
+async def _load_key_row_by_uuid_async(db: Session, uuid_value: str) -> Optional[KeyRow]:
+    """_load_key_row_by_uuid для async-эндпоинтов (промах кэша — в threadpool)."""
+    cached = _cached_key_row_by_uuid(uuid_value, time.monotonic())
+    if cached is not None:
+        return cached
+    return await run_in_threadpool(_load_key_row_by_uuid, db, uuid_value)
+
+
+def invalidate_key_cache(key_id: int) -> None:
+    """Убрать ключ из key_cache (после удаления) и сбросить кэш списка ключей."""
+    global _key_cache_generation
+    with _key_cache_lock:
+        cached = key_cache.pop(key_id, None)
+        if cached is not None:
+            key_uuid_index.pop(cached[0].uuid, None)
+        key_list_cache.clear()
+        _key_cache_generation += 1
+    _publish_key_cache_stamp()
+
+
+def _invalidate_key_list_cache() -> int:
+    """Сбросить кэш GET /api/keys (после create_key); возвращает новое поколение."""
+    global _key_cache_generation
+    with _key_cache_lock:
+        key_list_cache.clear()
+        _key_cache_generation += 1
+    _publish_key_cache_stamp()
+    return _key_cache_generation
+
+
+def _delete_key_row(db: Session, key_id: int) -> None:
+    """
+    Удаление ключа и его traffic_stats из БД и из key_cache.
+    Синхронная функция: из async-эндпоинтов вызывать через run_in_threadpool.
+    """
+    # Core DELETE без загрузки Key; traffic_stats удаляем явно, т.к. в старых
+    # БД внешний ключ создан без ON DELETE CASCADE
+    db.execute(delete(TrafficStats).where(TrafficStats.key_id == key_id))
+    db.execute(delete(Key).where(Key.id == key_id))
+    db.commit()
+    invalidate_key_cache(key_id)
+
+
+def _key_response(key: "Key | KeyRow") -> KeyResponse:
+    """
+    KeyResponse из строки БД без повторной валидации (model_construct):
+    данные уже типизированы схемой БД, FastAPI всё равно проверит response_model.
+    """
+    return KeyResponse.model_construct(
+        key_id=int(key.id),  # type: ignore[arg-type]
+        uuid=key.uuid,
+        short_id=COMMON_SHORT_ID,  # Возвращаем общий short_id
+        name=key.name,
+        created_at=key.created_at,
+        is_active=bool(key.is_active),
+    )
+
+
 ENABLE_BACKGROUND_TRAFFIC_SYNC = settings.enable_background_traffic_sync
 BACKGROUND_TRAFFIC_SYNC_INTERVAL_S = settings.background_traffic_sync_interval_s
-BACKGROUND_TRAFFIC_SYNC_BATCH_SIZE = settings.background_traffic_sync_batch_size
+XRAY_SYNC_CONCURRENCY = settings.xray_sync_concurrency
+# Общий short_id всех ключей; ссылки берут его из settings (ключ кэша шаблонов)
+COMMON_SHORT_ID = settings.reality_common_short_id
 _traffic_sync_lock = asyncio.Lock()
-_traffic_sync_cursor = 0
+_traffic_sync_task: Optional[asyncio.Task] = None
+# Дескриптор flock лидера фоновых задач (один воркер из --workers N)
+_background_leader_fd: Optional[int] = None
 
 # Фоновая синхронизация пользователей БД → Xray (startup / sync-config)
 _user_sync_task: Optional[asyncio.Task] = None
@@ -186,9 +470,21 @@ def _is_scanner_probe(path: str) -> bool:
     return any(marker in lower for marker in _SCANNER_PROBE_SUBSTRINGS)
 
 
+# Слушатель очереди логов: файловый/консольный вывод в отдельном потоке
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
 # Настройка логирования
 def setup_logging():
-    """Настройка логирования с файловым выводом и ротацией"""
+    """
+    Настройка логирования с файловым выводом и ротацией.
+
+    На root logger вешается только QueueHandler: запись в файл, ротация и
+    вывод в консоль выполняются QueueListener в фоновом потоке, поэтому
+    logger.info(...) из корутин не блокирует event loop на дисковом I/O.
+    """
+    global _log_listener
+
     log_level = getattr(settings, "log_level", "INFO")
     log_file = getattr(settings, "log_file", "./logs/veil_xray_api.log")
     log_max_bytes = getattr(settings, "log_max_bytes", 10485760)  # 10MB
@@ -203,13 +499,20 @@ def setup_logging():
     log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     date_format = "%Y-%m-%d %H:%M:%S"
 
+    # Уровень и форматтер вычисляются один раз и общие для всех handlers
+    level = getattr(logging, log_level.upper(), logging.INFO)
+    formatter = logging.Formatter(log_format, date_format)
+
     # Настройка root logger
     root_logger = logging.getLogger()
-    root_logger.setLevel(getattr(logging, log_level.upper(), logging.INFO))
+    root_logger.setLevel(level)
 
-    # Удаляем существующие handlers
+    # Останавливаем предыдущий listener (повторный вызов) и удаляем handlers
+    stop_logging()
     root_logger.handlers.clear()
 
+    handlers: List[logging.Handler] = []
+
     # Handler для файла с ротацией
     if log_file:
         file_handler = logging.handlers.RotatingFileHandler(
@@ -218,21 +521,50 @@ def setup_logging():
             backupCount=log_backup_count,
             encoding="utf-8",
         )
-        file_handler.setLevel(getattr(logging, log_level.upper(), logging.INFO))
-        file_formatter = logging.Formatter(log_format, date_format)
-        file_handler.setFormatter(file_formatter)
-        root_logger.addHandler(file_handler)
+        file_handler.setLevel(level)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
 
     # Handler для консоли (stdout)
     console_handler = logging.StreamHandler()
-    console_handler.setLevel(getattr(logging, log_level.upper(), logging.INFO))
-    console_formatter = logging.Formatter(log_format, date_format)
-    console_handler.setFormatter(console_formatter)
-    root_logger.addHandler(console_handler)
+    console_handler.setLevel(level)
+    console_handler.setFormatter(formatter)
+    handlers.append(console_handler)
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True
+    )
+    _log_listener.start()
+
+
+def stop_logging() -> None:
+    """
+    Остановить QueueListener, дописав накопленные записи.
+
+    Handlers слушателя переносятся обратно на root logger, чтобы логи,
+    выпущенные после остановки (завершение uvicorn), не терялись.
+    """
+    global _log_listener
+
+    listener = _log_listener
+    if listener is None:
+        return
+    _log_listener = None
+    listener.stop()
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root_logger.removeHandler(handler)
+    for handler in listener.handlers:
+        root_logger.addHandler(handler)
 
 
 # Инициализация логирования
 setup_logging()
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
 
 # Инициализация FastAPI (документация включается только при API_ENABLE_DOCS=true)
@@ -242,51 +574,64 @@ if not settings.api_enable_docs:
 
 
 # Middleware для логирования запросов и ошибок
+def _request_full_path(request: Request) -> str:
+    """path?query из ASGI scope (без построения request.url)."""
+    path = request.scope["path"]
+    query = request.scope.get("query_string", b"")
+    return f"{path}?{query.decode('latin-1')}" if query else path
+
+
 class LoggingMiddleware(BaseHTTPMiddleware):
     """Middleware для логирования всех запросов и ошибок с полными деталями"""
 
     async def dispatch(self, request: Request, call_next):
-        start_time = time.time()
-        request_path = str(request.url.path)
+        start_time = time.perf_counter()
         request_method = request.method
-        query_params = str(request.url.query) if request.url.query else ""
-        full_path = f"{request_path}?{query_params}" if query_params else request_path
 
         try:
             response = await call_next(request)
-            process_time = time.time() - start_time
+            process_time = time.perf_counter() - start_time
             status_code = response.status_code
 
+            # Строку пути собираем только если запись действительно будет выведена;
+            # %-аргументы форматирует logging, а не каждый запрос
             if status_code >= 400:
-                log_msg = (
-                    f"⚠️  {request_method} {full_path} - "
-                    f"Status: {status_code} - "
-                    f"Time: {process_time:.3f}s"
-                )
-                if status_code == 403 and _is_scanner_probe(request_path):
-                    logger.debug(log_msg)
+                if status_code == 403 and _is_scanner_probe(request.scope["path"]):
+                    log = logger.debug
+                    level = logging.DEBUG
                 else:
-                    logger.warning(log_msg)
-            else:
+                    log = logger.warning
+                    level = logging.WARNING
+                if logger.isEnabledFor(level):
+                    log(
+                        "⚠️  %s %s - Status: %d - Time: %.3fs",
+                        request_method,
+                        _request_full_path(request),
+                        status_code,
+                        process_time,
+                    )
+            elif logger.isEnabledFor(logging.INFO):
                 logger.info(
-                    f"{request_method} {full_path} - "
-                    f"Status: {status_code} - "
-                    f"Time: {process_time:.3f}s"
+                    "%s %s - Status: %d - Time: %.3fs",
+                    request_method,
+                    _request_full_path(request),
+                    status_code,
+                    process_time,
                 )
             return response
         except HTTPException as e:
-            process_time = time.time() - start_time
+            process_time = time.perf_counter() - start_time
             logger.error(
-                f"❌ HTTPException in {request_method} {full_path} - "
+                f"❌ HTTPException in {request_method} {_request_full_path(request)} - "
                 f"Status: {e.status_code} - "
                 f"Detail: {e.detail} - "
                 f"Time: {process_time:.3f}s"
             )
             raise
         except Exception as e:
-            process_time = time.time() - start_time
+            process_time = time.perf_counter() - start_time
             logger.exception(
-                f"❌ Error processing {request_method} {full_path} - "
+                f"❌ Error processing {request_method} {_request_full_path(request)} - "
                 f"Time: {process_time:.3f}s - "
                 f"Error: {type(e).__name__}: {e}"
             )
@@ -389,17 +734,16 @@ class ForceHTTPSMiddleware(BaseHTTPMiddleware):
 
     async def dispatch(self, request: Request, call_next):
         # Проверяем заголовок X-Forwarded-Proto (устанавливается reverse proxy)
-        forwarded_proto = request.headers.get("X-Forwarded-Proto", "")
-        host = request.headers.get("Host", "")
+        headers = request.headers
 
-        # Если запрос пришел по HTTP через reverse proxy, перенаправляем на HTTPS
-        if forwarded_proto == "http" and host:
-            url = request.url
-            https_url = url.replace(scheme="https")
-            return RedirectResponse(url=str(https_url), status_code=301)
+        # Если запрос пришел по HTTP через reverse proxy, перенаправляем на HTTPS;
+        # URL собираем из Host и scope, без построения и копирования request.url
+        if headers.get("x-forwarded-proto") == "http" and (host := headers.get("host")):
+            return RedirectResponse(
+                url=f"https://{host}{_request_full_path(request)}", status_code=301
+            )
 
-        response = await call_next(request)
-        return response
+        return await call_next(request)
 
 
 # Security
@@ -410,16 +754,40 @@ xray_client = XrayClient()
 xray_config_manager = XrayConfigManager()
 
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Проверка токена авторизации"""
-    token = credentials.credentials
-    key = settings.api_secret_key
-    if len(token) != len(key) or not secrets.compare_digest(token, key):
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Invalid authentication token",
-        )
-    return token
+# Секрет API в байтах: вычисляется один раз, а не на каждый запрос
+class AuthChecker:
+    """Зависимость проверки Bearer-токена; секрет кодируется в bytes один раз"""
+
+    def __init__(self, secret: str):
+        # Результат проверки намеренно не кэшируется: поиск в кэше по токену
+        # (хэш или ==) дороже compare_digest на ~32 байтах и не постоянен по времени
+        self.secret = secret.encode("utf-8")
+
+    def __call__(
+        self, credentials: HTTPAuthorizationCredentials = Depends(security)
+    ) -> str:
+        token = credentials.credentials
+        # Сравнение bytes за постоянное время (str с не-ASCII compare_digest не принимает)
+        if not hmac.compare_digest(token.encode("utf-8"), self.secret):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid authentication token",
+            )
+        return token
+
+
+verify_token = AuthChecker(settings.api_secret_key)
+
+
+def _load_active_keys(*columns: Any) -> Sequence[Row]:
+    """
+    Выбранные столбцы активных ключей (по возрастанию id) в короткой сессии.
+    Синхронная функция: из корутин вызывать через run_in_threadpool.
+    """
+    with db_module.SessionLocal() as db:
+        return db.execute(
+            select(*columns).where(Key.is_active == 1).order_by(Key.id.asc())
+        ).all()
 
 
 async def sync_users_with_xray() -> dict[str, int]:
@@ -439,10 +807,9 @@ async def sync_users_with_xray() -> dict[str, int]:
         "total_keys": 0,
     }
 
-    db: Session = next(get_db())
     try:
-        # Получаем все активные ключи из БД
-        keys = db.query(Key).filter(Key.is_active == 1).all()
+        # Получаем все активные ключи из БД (короткая сессия в threadpool)
+        keys = await run_in_threadpool(_load_active_keys, Key.id, Key.uuid, Key.email)
 
         if not keys:
             logger.info("No active keys found in database. Nothing to sync.")
@@ -466,9 +833,54 @@ async def sync_users_with_xray() -> dict[str, int]:
         skipped_count = 0
         error_count = 0
 
-        users_for_config = [(key.uuid, f"user_{key.id}_{key.uuid[:8]}") for key in keys]
+        users_for_config = [(key.uuid, key.email) for key in keys]
+        # Запись config.json (синхронный файловый I/O) — в отдельном потоке,
+        # чтобы не блокировать event loop и идти параллельно с вызовами xray API
+        config_task = asyncio.create_task(
+            asyncio.to_thread(
+                xray_config_manager.bulk_sync_vless_clients, users_for_config
+            )
+        )
+
+        semaphore = asyncio.Semaphore(XRAY_SYNC_CONCURRENCY)
+
+        async def _sync_one(key: Row) -> bool:
+            """Добавить пользователя в Xray API; True — если добавлен."""
+            if not xray_api_available:
+                return False
+            email = key.email
+            async with semaphore:
+                try:
+                    api_success = await xray_client.add_user(
+                        uuid=key.uuid, email=email, flow=settings.reality_flow
+                    )
+                except Exception as api_error:
+                    logger.warning(
+                        f"⚠️  Failed to add user {key.id} to Xray API: {api_error}"
+                    )
+                    return False
+
+            if api_success:
+                logger.info(
+                    f"✅ Synced user {key.id} (UUID: {key.uuid[:8]}..., email: {email}) "
+                    f"to Xray API"
+                )
+            else:
+                # Пользователь может уже существовать в Xray, это нормально
+                # %-аргументы: срез UUID и строка не строятся при выключенном DEBUG
+                logger.debug(
+                    "⏭️  User %s (UUID: %.8s...) may already exist in Xray API",
+                    key.id,
+                    key.uuid,
+                )
+            return bool(api_success)
+
+        results = await asyncio.gather(
+            *(_sync_one(key) for key in keys), return_exceptions=True
+        )
+
         try:
-            bulk = xray_config_manager.bulk_sync_vless_clients(users_for_config)
+            bulk = await config_task
             if bulk.get("saved"):
                 synced_config_count = bulk.get("added", 0) + bulk.get(
                     "already_present", 0
@@ -486,44 +898,17 @@ async def sync_users_with_xray() -> dict[str, int]:
             error_count += 1
             logger.error(f"Bulk config sync exception: {config_error}")
 
-        for key in keys:
-            try:
-                email = f"user_{key.id}_{key.uuid[:8]}"
-                api_updated = False
-
-                if xray_api_available:
-                    try:
-                        api_success = await xray_client.add_user(
-                            uuid=key.uuid, email=email, flow=settings.reality_flow
-                        )
-
-                        if api_success:
-                            api_updated = True
-                            synced_api_count += 1
-                            logger.info(
-                                f"✅ Synced user {key.id} (UUID: {key.uuid[:8]}..., email: {email}) "
-                                f"to Xray API"
-                            )
-                        else:
-                            # Пользователь может уже существовать в Xray, это нормально
-                            logger.debug(
-                                f"⏭️  User {key.id} (UUID: {key.uuid[:8]}...) "
-                                f"may already exist in Xray API"
-                            )
-                    except Exception as api_error:
-                        logger.warning(
-                            f"⚠️  Failed to add user {key.id} to Xray API: {api_error}"
-                        )
-
-                if not api_updated:
-                    skipped_count += 1
-
-            except Exception as e:
+        for key, result in zip(keys, results):
+            if isinstance(result, BaseException):
                 error_count += 1
                 logger.error(
                     f"❌ Error syncing user {key.id} (UUID: {key.uuid[:8]}...) "
-                    f"to Xray: {e}"
+                    f"to Xray: {result}"
                 )
+            elif result:
+                synced_api_count += 1
+            else:
+                skipped_count += 1
 
         logger.info(
             f"🔄 User synchronization completed: "
@@ -541,14 +926,139 @@ async def sync_users_with_xray() -> dict[str, int]:
     except Exception as e:
         logger.error(f"❌ Error during user synchronization: {e}")
         raise
-    finally:
-        db.close()
+
+
+async def _collect_traffic_stats(
+    keys: Sequence[Row[Any]], updated_at: int
+) -> tuple[dict[int, tuple[int, int, int]], int]:
+    """
+    Статистика Xray для пар (key_id, email) одним вызовом get_all_user_stats.
+
+    Ключи без счётчиков в Xray получают нули; если Xray не ответил,
+    все ключи считаются ошибками и ничего не обновляется.
+
+    Returns:
+        ({key_id: (upload, download, updated_at)}, число ошибок)
+    """
+    all_stats = await xray_client.get_all_user_stats()
+    if all_stats is None:
+        logger.debug(f"Traffic sync skipped for {len(keys)} key(s): Xray stats failed")
+        return {}, len(keys)
+
+    stats_by_key: dict[int, tuple[int, int, int]] = {}
+    for key_id, email in keys:
+        user_stats = all_stats.get(email, {})
+        stats_by_key[int(key_id)] = (
+            int(user_stats.get("upload", 0)),
+            int(user_stats.get("download", 0)),
+            updated_at,
+        )
+    return stats_by_key, 0
+
+
+# Строк в одном многострочном upsert: 4 параметра на строку, лимит SQLite —
+# 32766 переменных на запрос
+_TRAFFIC_UPSERT_CHUNK = 1000
+
+
+def _traffic_upsert(rows: List[dict], dialect_insert: Any = sqlite_insert):
+    """
+    Многострочный INSERT ... ON CONFLICT (key_id) DO UPDATE для traffic_stats.
+
+    dialect_insert — sqlite_insert или pg_insert (оба поддерживают excluded).
+    """
+    stmt = dialect_insert(TrafficStats).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[TrafficStats.key_id],
+        set_={
+            "upload": stmt.excluded.upload,
+            "download": stmt.excluded.download,
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+
+
+def _store_traffic_stats(
+    db: Session, stats_by_key: dict[int, tuple[int, int, int]]
+) -> int:
+    """
+    Записать статистику пачкой: многострочные INSERT ... ON CONFLICT (key_id)
+    по UNIQUE(key_id), без предварительного SELECT, и один commit.
+
+    Returns:
+        Количество записанных ключей
+    """
+    if not stats_by_key:
+        return 0
+    dialect_insert = (
+        pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+    )
+    rows = [
+        {
+            "key_id": key_id,
+            "upload": upload,
+            "download": download,
+            "updated_at": updated_at,
+        }
+        for key_id, (upload, download, updated_at) in stats_by_key.items()
+    ]
+    for start in range(0, len(rows), _TRAFFIC_UPSERT_CHUNK):
+        db.execute(
+            _traffic_upsert(rows[start : start + _TRAFFIC_UPSERT_CHUNK], dialect_insert)
+        )
+    db.commit()
+    return len(stats_by_key)
+
+
+def _save_traffic_stats(stats_by_key: dict[int, tuple[int, int, int]]) -> int:
+    """_store_traffic_stats в собственной сессии (для вызова через run_in_threadpool)."""
+    with db_module.SessionLocal() as db:
+        return _store_traffic_stats(db, stats_by_key)
+
+
+def _upsert_traffic_row(key_id: int, upload: int, download: int, updated_at: int):
+    """Одна строка TrafficStats через INSERT ... ON CONFLICT(key_id) DO UPDATE."""
+    with db_module.SessionLocal() as db:
+        _store_traffic_stats(db, {key_id: (upload, download, updated_at)})
+
+
+async def _sync_traffic_once() -> None:
+    """
+    Один проход фоновой синхронизации: счётчики всех активных ключей Xray → БД.
+
+    get_all_user_stats и так возвращает всех пользователей одним statsquery,
+    поэтому записываются все ключи (многострочные upsert по
+    _TRAFFIC_UPSERT_CHUNK строк), а не отдельная пачка.
+    """
+    # Ручная /api/traffic/sync или предыдущий проход ещё работают — пропускаем
+    if _traffic_sync_lock.locked():
+        return
+
+    async with _traffic_sync_lock:
+        keys = await run_in_threadpool(_load_active_keys, Key.id, Key.email)
+
+        if not keys:
+            return
+
+        stats_by_key, _ = await _collect_traffic_stats(keys, int(time.time()))
+
+        if not stats_by_key:
+            return
+
+        try:
+            await run_in_threadpool(_save_traffic_stats, stats_by_key)
+        except Exception as e:
+            logger.warning(f"Background traffic sync DB update failed: {e}")
 
 
 async def sync_all_traffic_stats():
-    """Фоновая задача для синхронизации статистики всех ключей"""
-    global _traffic_sync_cursor
+    """
+    Фоновая задача для синхронизации статистики всех ключей.
 
+    Проходы идут последовательно (следующий ждёт окончания предыдущего);
+    проход дольше интервала прерывается, чтобы зависший вызов Xray
+    не останавливал синхронизацию навсегда.
+    """
     if not ENABLE_BACKGROUND_TRAFFIC_SYNC:
         logger.info(
             "⏸️  Background traffic sync is disabled (ENABLE_BACKGROUND_TRAFFIC_SYNC=false)"
@@ -559,81 +1069,55 @@ async def sync_all_traffic_stats():
         try:
             await asyncio.sleep(BACKGROUND_TRAFFIC_SYNC_INTERVAL_S)
 
-            if _traffic_sync_lock.locked():
-                continue
-
-            async with _traffic_sync_lock:
-                with db_module.SessionLocal() as db:
-                    keys = (
-                        db.query(Key.id, Key.uuid)
-                        .filter(Key.is_active == 1)
-                        .order_by(Key.id.asc())
-                        .all()
-                    )
-
-                if not keys:
-                    continue
+            try:
+                await asyncio.wait_for(
+                    _sync_traffic_once(), timeout=BACKGROUND_TRAFFIC_SYNC_INTERVAL_S
+                )
+            except asyncio.TimeoutError:
+                logger.warning(
+                    "⚠️  Background traffic sync run exceeded "
+                    f"{BACKGROUND_TRAFFIC_SYNC_INTERVAL_S}s and was cancelled"
+                )
 
-                start = _traffic_sync_cursor % len(keys)
-                batch = keys[start : start + BACKGROUND_TRAFFIC_SYNC_BATCH_SIZE]
-                if len(batch) < BACKGROUND_TRAFFIC_SYNC_BATCH_SIZE:
-                    batch += keys[: BACKGROUND_TRAFFIC_SYNC_BATCH_SIZE - len(batch)]
-                _traffic_sync_cursor = (start + len(batch)) % len(keys)
+        except Exception as e:
+            logger.error(f"Error in background traffic sync: {e}")
 
-                now = int(time.time())
-                stats_by_key: dict[int, tuple[int, int, int]] = {}
 
-                for key_id, key_uuid in batch:
-                    try:
-                        email = f"user_{key_id}_{str(key_uuid)[:8]}"
-                        xray_stats = await xray_client.get_user_stats(email)
-                        upload = int(xray_stats.get("upload", 0) or 0)
-                        download = int(xray_stats.get("download", 0) or 0)
-                        stats_by_key[int(key_id)] = (upload, download, now)
-                    except Exception as e:
-                        logger.debug(f"Traffic sync skipped for key {key_id}: {e}")
+def _acquire_background_leader() -> bool:
+    """
+    True, если этот процесс выполняет фоновые задачи (startup sync, трафик).
 
-                if not stats_by_key:
-                    continue
+    При uvicorn --workers N lifespan запускается в каждом воркере; неблокирующий
+    flock на общем файле получает только один из них, остальные обслуживают HTTP.
+    Замок держится до _release_background_leader() или завершения процесса.
+    """
+    global _background_leader_fd
+    if _background_leader_fd is not None:
+        return True
+    lock_path = Path(settings.background_leader_lock_file)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    _background_leader_fd = fd
+    return True
 
-                key_ids = list(stats_by_key.keys())
-                try:
-                    with db_module.SessionLocal() as db:
-                        existing = {
-                            ts.key_id: ts
-                            for ts in db.query(TrafficStats)
-                            .filter(TrafficStats.key_id.in_(key_ids))
-                            .all()
-                        }
-                        for key_id, (
-                            upload,
-                            download,
-                            updated_at,
-                        ) in stats_by_key.items():
-                            ts = existing.get(key_id)
-                            if ts:
-                                ts.upload = upload  # type: ignore
-                                ts.download = download  # type: ignore
-                                ts.updated_at = updated_at  # type: ignore
-                            else:
-                                db.add(
-                                    TrafficStats(
-                                        key_id=key_id,
-                                        upload=upload,
-                                        download=download,
-                                        updated_at=updated_at,
-                                    )
-                                )
-                        db.commit()
-                except Exception as e:
-                    logger.warning(f"Background traffic sync DB update failed: {e}")
 
-        except Exception as e:
-            logger.error(f"Error in background traffic sync: {e}")
+def _release_background_leader() -> None:
+    """Отпустить замок лидера фоновых задач (при остановке воркера)."""
+    global _background_leader_fd
+    if _background_leader_fd is None:
+        return
+    os.close(_background_leader_fd)
+    _background_leader_fd = None
 
 
 async def _app_startup() -> None:
     """Инициализация при запуске."""
+    global _traffic_sync_task
     logger.info("🚀 Starting Veil Xray API server...")
 
     logger.info("📦 Initializing database...")
@@ -643,35 +1127,45 @@ async def _app_startup() -> None:
     await config_task_queue.start()
     logger.info("✅ Config task queue started")
 
-    common_short_id = settings.reality_common_short_id
-    xray_config_manager.ensure_common_short_id(common_short_id)
+    common_short_id = COMMON_SHORT_ID
+    await asyncio.to_thread(xray_config_manager.ensure_common_short_id, common_short_id)
     logger.info(f"✅ Common short_id '{common_short_id}' ensured in Xray config")
 
-    schedule_user_sync("startup")
-    logger.info("✅ User sync scheduled in background (startup)")
-
-    if ENABLE_BACKGROUND_TRAFFIC_SYNC:
-        asyncio.create_task(sync_all_traffic_stats())
-        logger.info("✅ Background traffic sync task started")
+    if not _acquire_background_leader():
+        logger.info(
+            "⏭️  Background jobs are run by another worker "
+            f"(leader lock {settings.background_leader_lock_file} is held)"
+        )
     else:
-        logger.info("⏸️  Background traffic sync task is disabled")
+        schedule_user_sync("startup")
+        logger.info("✅ User sync scheduled in background (startup)")
+
+        if ENABLE_BACKGROUND_TRAFFIC_SYNC:
+            _traffic_sync_task = asyncio.create_task(sync_all_traffic_stats())
+            logger.info("✅ Background traffic sync task started")
+        else:
+            logger.info("⏸️  Background traffic sync task is disabled")
 
     logger.info("✅ API server started successfully")
 
 
 async def _app_shutdown() -> None:
     """Остановка при завершении работы."""
-    global _user_sync_task
+    global _user_sync_task, _traffic_sync_task
     logger.info("🛑 Shutting down Veil Xray API server...")
-    if _user_sync_task is not None and not _user_sync_task.done():
-        _user_sync_task.cancel()
-        try:
-            await _user_sync_task
-        except asyncio.CancelledError:
-            pass
+    for task in (_user_sync_task, _traffic_sync_task):
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    _traffic_sync_task = None
+    _release_background_leader()
     await config_task_queue.stop()
     logger.info("✅ Config task queue stopped")
     logger.info("✅ API server stopped")
+    stop_logging()
 
 
 @asynccontextmanager
@@ -689,9 +1183,16 @@ app = FastAPI(
     description="API для управления VLESS+Reality VPN сервером",
     version="1.3.22",
     lifespan=lifespan,
+    # orjson (C) вместо json.dumps: заметно быстрее на больших списках/конфигах
+    default_response_class=ORJSONResponse,
     **_docs_kw,
 )
 
+# Ошибки БД в read-эндпоинтах без собственного try/except → 503/500 здесь
+app.add_exception_handler(SQLAlchemyError, sqlalchemy_error_handler)
+# Прочие непойманные исключения → 500 в том же формате {"detail": ...}
+app.add_exception_handler(Exception, generic_error_handler)
+
 app.add_middleware(LoggingMiddleware)
 app.add_middleware(IPWhitelistMiddleware)
 # app.add_middleware(ForceHTTPSMiddleware)
@@ -716,11 +1217,16 @@ def _health_payload() -> dict[str, str]:
     return {"status": "ok", "service": "veil-xray-api"}
 
 
+# Тело health-ответа сериализуется один раз. Response создаётся на каждый
+# запрос: middleware (CORS) дописывают заголовки в raw_headers ответа
+_HEALTH_BODY = orjson.dumps(_health_payload())
+
+
 @app.get("/", tags=["Health"])
 @app.get("/health", tags=["Health"])
 async def root():
     """Проверка работоспособности API (корень и /health для мониторинга)."""
-    return _health_payload()
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 
 @app.get(
@@ -765,8 +1271,12 @@ async def sync_xray_config(token: str = Depends(verify_token)):
     )
 
 
+# Попыток INSERT ключа при коллизии UUID (unique-индекс keys.uuid)
+_CREATE_KEY_MAX_ATTEMPTS = 5
+
+
 @app.post("/api/keys", response_model=KeyResponse, tags=["Keys"])
-async def create_key(
+def create_key(
     key_data: KeyCreate,
     background_tasks: BackgroundTasks,
     token: str = Depends(verify_token),
@@ -778,33 +1288,58 @@ async def create_key(
     - Генерирует UUID и Short ID
     - Добавляет пользователя в Xray без перезагрузки
     - Сохраняет ключ в базу данных
+
+    Обычный def: FastAPI выполняет обработчик в threadpool, INSERT/commit не
+    блокируют event loop. Выдача в Xray — async-задача в фоне (BackgroundTasks).
     """
     try:
-        # Генерация уникальных параметров
-        uuid_value = generate_uuid()
         # Используем общий short_id для всех пользователей
-        common_short_id = settings.reality_common_short_id
+        common_short_id = COMMON_SHORT_ID
 
-        # Создание записи в базе данных
+        # Создание записи в базе данных. Уникальность UUID гарантирует
+        # unique-индекс: сразу пробуем INSERT, при коллизии — новый UUID.
         timestamp = int(time.time())
-        new_key = Key(
+        for attempt in range(1, _CREATE_KEY_MAX_ATTEMPTS + 1):
+            uuid_value = generate_uuid()
+            new_key = Key(
+                uuid=uuid_value,
+                short_id=common_short_id,  # Используем общий short_id
+                name=key_data.name,
+                created_at=timestamp,
+                is_active=1,
+            )
+            db.add(new_key)
+            try:
+                db.flush()
+                break
+            except IntegrityError:
+                db.rollback()
+                if attempt == _CREATE_KEY_MAX_ATTEMPTS:
+                    raise
+                logger.warning(
+                    f"⚠️  UUID collision on create_key (attempt {attempt}), retrying"
+                )
+
+        # id известен после flush: Key и TrafficStats уходят одной транзакцией,
+        # без refresh (лишнего SELECT) после commit
+        key_id = int(new_key.id)  # type: ignore
+        email = xray_email(key_id, uuid_value)
+        new_key.email = email  # type: ignore
+        db.add(TrafficStats(key_id=key_id, upload=0, download=0, updated_at=timestamp))
+        db.commit()
+        generation = _invalidate_key_list_cache()
+        created = KeyRow(
+            id=key_id,
             uuid=uuid_value,
-            short_id=common_short_id,  # Используем общий short_id
+            short_id=common_short_id,
             name=key_data.name,
             created_at=timestamp,
             is_active=1,
+            email=email,
         )
-
-        db.add(new_key)
-        db.flush()
-        db.add(
-            TrafficStats(key_id=new_key.id, upload=0, download=0, updated_at=timestamp)
-        )
-        db.commit()
-        db.refresh(new_key)
-
-        key_id = int(new_key.id)  # type: ignore
-        email = f"user_{key_id}_{uuid_value[:8]}"
+        # Новый ключ сразу доступен read-эндпоинтам из key_cache (по id и UUID)
+        # (если его уже успели удалить, поколение сменилось и кэш пропускается)
+        _cache_key_row(created, time.monotonic(), generation)
 
         async def _provision_user() -> None:
             try:
@@ -833,14 +1368,7 @@ async def create_key(
 
         logger.info(f"Key created successfully: {key_id}, UUID: {uuid_value[:8]}...")
 
-        return KeyResponse(
-            key_id=key_id,
-            uuid=new_key.uuid,  # type: ignore
-            short_id=common_short_id,  # Возвращаем общий short_id
-            name=new_key.name,  # type: ignore
-            created_at=new_key.created_at,  # type: ignore
-            is_active=bool(new_key.is_active),  # type: ignore
-        )
+        return _key_response(created)
 
     except HTTPException:
         raise
@@ -856,9 +1384,135 @@ async def create_key(
         )
 
 
+async def _remove_user_from_config_file(key_id: int, uuid: str, email: str) -> bool:
+    """
+    Удалить пользователя из config.json через очередь задач и дождаться результата.
+
+    Если очередь не ответила за 30 с или упала — один прямой вызов
+    remove_user_from_config в потоке. Возвращает итог без исключений.
+    """
+    try:
+        config_success = await config_task_queue.execute_task_and_wait(
+            task_type=TaskType.REMOVE_USER,
+            uuid=uuid,
+            short_id=COMMON_SHORT_ID,  # Используем общий short_id
+            email=email,
+            timeout=30.0,  # Таймаут 30 секунд
+        )
+    except asyncio.TimeoutError:
+        logger.error(
+            f"❌ Timeout waiting for config update for key {key_id} (UUID: {uuid[:8]}...). "
+            f"Trying direct fallback..."
+        )
+        config_success = None
+    except Exception as e:
+        logger.error(
+            f"❌ Error removing user {key_id} from config: {e}. Trying direct fallback..."
+        )
+        config_success = None
+
+    if config_success is None:
+        # Fallback: прямой вызов, если очередь не отвечает или упала
+        try:
+            return await asyncio.to_thread(
+                xray_config_manager.remove_user_from_config,
+                uuid=uuid,
+                short_id=COMMON_SHORT_ID,
+            )
+        except Exception as e:
+            logger.error(f"❌ Fallback config removal also failed: {e}")
+            return False
+
+    if config_success:
+        logger.info(
+            f"✅ User {key_id} (UUID: {uuid[:8]}...) removed from Xray config file"
+        )
+    else:
+        logger.warning(
+            f"⚠️  Failed to remove user {key_id} (UUID: {uuid[:8]}...) "
+            f"from Xray config file"
+        )
+    return bool(config_success)
+
+
+async def _remove_xray_api_user(key_id: int, email: str) -> bool:
+    """xray_client.remove_user без исключений: True — пользователь отозван."""
+    try:
+        return bool(await xray_client.remove_user(email))
+    except Exception as e:
+        logger.warning(f"⚠️  Xray API remove_user failed for key {key_id}: {e}")
+        return False
+
+
+async def _remove_deleted_key_from_config(
+    key_id: int, uuid: str, email: str, retry_api: bool = False
+) -> None:
+    """
+    Фоновая очистка после удаления ключа из БД: config.json и, если отзыв
+    через Xray API не удался в запросе, повторный remove_user.
+    """
+    if not await _remove_user_from_config_file(key_id, uuid, email):
+        logger.warning(
+            f"⚠️  Key {key_id} was removed from database, but user may still exist in Xray config file. "
+            f"Manual cleanup may be required."
+        )
+
+    if retry_api:
+        if await _remove_xray_api_user(key_id, email):
+            logger.info(f"✅ User {key_id} removed from Xray API on retry")
+        else:
+            logger.warning(
+                f"⚠️  Key {key_id} was removed from database, but user is still active in Xray API. "
+                f"It will be dropped on the next Xray restart (config.json is cleaned)."
+            )
+
+
+async def _delete_key(
+    key: KeyRow, db: Session, background_tasks: BackgroundTasks
+) -> KeyDeleteResponse:
+    """
+    Общая часть DELETE /api/keys/{identifier} и /api/keys/uuid/{uuid}.
+
+    - Сначала удаляет ключ и его статистику из БД (транзакция не ждёт Xray)
+    - Отзывает пользователя через Xray API (доступ пропадает до ответа)
+    - config.json чистится в фоне: очередь может ждать до 30 с
+    """
+    key_id = key.id
+    uuid = key.uuid
+    email = key.email
+
+    # Удаление из базы данных (каскадное удаление статистики)
+    await run_in_threadpool(_delete_key_row, db, key_id)
+
+    # Удаление пользователя из работающего Xray через API
+    api_removed = await _remove_xray_api_user(key_id, email)
+    if not api_removed:
+        logger.warning(
+            f"⚠️  Key {key_id} removed from database, but Xray API did not remove the user. "
+            f"Retrying in background."
+        )
+
+    # Удаление из конфигурационного файла (и повтор отзыва через API) —
+    # после ответа клиенту
+    background_tasks.add_task(
+        _remove_deleted_key_from_config,
+        key_id,
+        uuid,
+        email,
+        retry_api=not api_removed,
+    )
+
+    logger.info(f"Key deleted successfully: {key_id}")
+
+    return KeyDeleteResponse(success=True, message=f"Key {key_id} deleted successfully")
+
+
 @app.delete("/api/keys/{identifier}", response_model=KeyDeleteResponse, tags=["Keys"])
 async def delete_key(
-    identifier: str, token: str = Depends(verify_token), db: Session = Depends(get_db)
+    identifier: str,
+    background_tasks: BackgroundTasks,
+    token: str = Depends(verify_token),
+    db: Session = Depends(get_db),
 ):
     """
     Удаление ключа по UUID или key_id
@@ -878,9 +1532,9 @@ async def delete_key(
             )
 
         if is_uuid:
-            key = db.query(Key).filter(Key.uuid == uuid_value).first()
+            key = await _load_key_row_by_uuid_async(db, uuid_value)  # type: ignore[arg-type]
         else:
-            key = db.query(Key).filter(Key.id == key_id_value).first()
+            key = await _load_key_row_async(db, key_id_value)  # type: ignore[arg-type]
 
         if not key:
             raise HTTPException(
@@ -888,94 +1542,17 @@ async def delete_key(
                 detail=f"Key not found",
             )
 
-        key_id = key.id  # type: ignore
-
-        # Удаление пользователя из Xray через API и конфигурационный файл
-        email = f"user_{key.id}_{key.uuid[:8]}"
+        return await _delete_key(key, db, background_tasks)
 
-        # Пытаемся удалить через Xray API
-        await xray_client.remove_user(email)
-
-        # Удаляем пользователя из конфигурационного файла и ждем выполнения
-        # Это гарантирует, что пользователь будет удален из конфигурации перед удалением из БД
-        config_success = False
-        try:
-            # Используем общий short_id для всех пользователей
-            common_short_id = settings.reality_common_short_id
-
-            # Используем execute_task_and_wait для гарантированного выполнения
-            config_success = await config_task_queue.execute_task_and_wait(
-                task_type=TaskType.REMOVE_USER,
-                uuid=key.uuid,  # type: ignore
-                short_id=common_short_id,  # Используем общий short_id
-                email=email,
-                timeout=30.0,  # Таймаут 30 секунд
-            )
-            if config_success:
-                logger.info(
-                    f"✅ User {key_id} (UUID: {key.uuid[:8]}...) removed from Xray config file"
-                )
-            else:
-                logger.warning(
-                    f"⚠️  Failed to remove user {key_id} (UUID: {key.uuid[:8]}...) "
-                    f"from Xray config file"
-                )
-        except asyncio.TimeoutError:
-            logger.error(
-                f"❌ Timeout waiting for config update for key {key_id} (UUID: {key.uuid[:8]}...). "
-                f"Trying direct fallback..."
-            )
-            # Fallback: прямой вызов если очередь не отвечает
-            try:
-                common_short_id = settings.reality_common_short_id
-                config_success = xray_config_manager.remove_user_from_config(
-                    uuid=key.uuid, short_id=common_short_id  # type: ignore
-                )
-            except Exception as e:
-                logger.error(f"❌ Fallback config removal also failed: {e}")
-                config_success = False
-        except Exception as e:
-            logger.error(
-                f"❌ Error removing user {key_id} from config: {e}. Trying direct fallback..."
-            )
-            # Fallback: прямой вызов при ошибке
-            try:
-                common_short_id = settings.reality_common_short_id
-                config_success = xray_config_manager.remove_user_from_config(
-                    uuid=key.uuid, short_id=common_short_id  # type: ignore
-                )
-            except Exception as fallback_error:
-                logger.error(f"❌ Fallback config removal also failed: {fallback_error}")
-                config_success = False
-
-        # Если удаление из конфигурации не удалось, логируем предупреждение
-        # но продолжаем удаление из БД (чтобы не блокировать операцию)
-        if not config_success:
-            logger.warning(
-                f"⚠️  Key {key_id} will be removed from database, but user may still exist in Xray config file. "
-                f"Manual cleanup may be required."
-            )
-
-        # Удаление из базы данных (каскадное удаление статистики)
-        # Теперь это происходит ПОСЛЕ попытки удаления из конфигурации
-        db.delete(key)
-        db.commit()
-
-        logger.info(f"Key deleted successfully: {key_id}")
-
-        return KeyDeleteResponse(
-            success=True, message=f"Key {key_id} deleted successfully"
-        )
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise_http_for_db_error(
-            e,
-            operation="delete_key",
-            default_detail="Failed to delete key",
-            db=db,
-        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise_http_for_db_error(
+            e,
+            operation="delete_key",
+            default_detail="Failed to delete key",
+            db=db,
+        )
 
 
 @app.get("/api/keys/{key_id}/traffic", response_model=TrafficResponse, tags=["Traffic"])
@@ -993,7 +1570,7 @@ async def get_traffic(
     - Обновляет данные в базе данных
     """
     try:
-        key = db.query(Key).filter(Key.id == key_id).first()
+        key = await _load_key_row_async(db, key_id)
 
         if not key:
             raise HTTPException(
@@ -1013,7 +1590,7 @@ async def get_traffic(
             upload = cached_stats[0]
             download = cached_stats[1]
             updated_at = cached_stats[3]
-            return TrafficResponse(
+            return TrafficResponse.model_construct(
                 key_id=key_id,
                 upload=upload,
                 download=download,
@@ -1028,7 +1605,7 @@ async def get_traffic(
                 pass
 
             # Получение статистики из Xray
-            email = f"user_{key.id}_{key.uuid[:8]}"
+            email = key.email
             xray_stats = await xray_client.get_user_stats(email)
 
             upload = xray_stats.get("upload", 0)
@@ -1040,32 +1617,13 @@ async def get_traffic(
 
             # Обновление статистики в базе данных короткой транзакцией
             try:
-                with db_module.SessionLocal() as db2:
-                    traffic_stat = (
-                        db2.query(TrafficStats)
-                        .filter(TrafficStats.key_id == key_id)
-                        .first()
-                    )
-
-                    if traffic_stat:
-                        traffic_stat.upload = upload  # type: ignore
-                        traffic_stat.download = download  # type: ignore
-                        traffic_stat.updated_at = updated_at  # type: ignore
-                    else:
-                        db2.add(
-                            TrafficStats(
-                                key_id=key_id,
-                                upload=upload,
-                                download=download,
-                                updated_at=updated_at,
-                            )
-                        )
-
-                    db2.commit()
+                await run_in_threadpool(
+                    _upsert_traffic_row, key_id, upload, download, updated_at
+                )
             except Exception as e:
                 logger.warning(f"Traffic DB update failed for key {key_id}: {e}")
 
-        return TrafficResponse(
+        return TrafficResponse.model_construct(
             key_id=key_id,
             upload=upload,
             download=download,
@@ -1084,8 +1642,88 @@ async def get_traffic(
         )
 
 
+# Шаблоны VLESS-ссылок: всё, кроме UUID, зависит только от настроек
+_UUID_PLACEHOLDER = "\x00uuid\x00"
+_vless_link_templates: dict[tuple, tuple[str, str]] = {}
+
+
+def _vless_link_template(profile: str) -> tuple[str, str]:
+    """
+    Префикс и суффикс ссылки вокруг UUID для профиля get_vless_link.
+
+    Ключ кэша включает используемые настройки, поэтому их смена даёт новый шаблон.
+    """
+    happ = profile in ("happ", "auto")
+    cache_key = (
+        happ,
+        settings.reality_public_key,
+        settings.reality_common_short_id,
+        settings.domain,
+        settings.reality_server_name,
+        settings.reality_port,
+        settings.reality_happ_port_tcp,
+        settings.reality_sni,
+        settings.reality_fingerprint,
+        settings.reality_flow,
+        settings.link_remark,
+    )
+    template = _vless_link_templates.get(cache_key)
+    if template is not None:
+        return template
+
+    public_key = normalize_reality_public_key(settings.reality_public_key)
+    if happ:
+        link = build_vless_link_with_transport(
+            uuid=_UUID_PLACEHOLDER,
+            short_id=settings.reality_common_short_id,
+            server_address=_server_address_for_links(),
+            port=settings.reality_happ_port_tcp,
+            sni=settings.reality_sni,
+            fingerprint="ios",
+            public_key=public_key,
+            flow="",
+            transport="tcp",
+            path="/",
+            remark=settings.link_remark,
+        )
+    else:
+        link = build_vless_link(
+            uuid=_UUID_PLACEHOLDER,
+            short_id=settings.reality_common_short_id,
+            server_address=settings.domain,
+            port=settings.reality_port,
+            sni=settings.reality_sni,
+            fingerprint=settings.reality_fingerprint,
+            public_key=public_key,
+            dest="vless_tcp_443",
+            flow=settings.reality_flow,
+        )
+    prefix, _, suffix = link.partition(_UUID_PLACEHOLDER)
+    template = (prefix, suffix)
+    _vless_link_templates[cache_key] = template
+    return template
+
+
+def _vless_link_response(key: KeyRow, profile: str) -> VlessLinkResponse:
+    """
+    Общая часть /link, /config и /uuid/{uuid}/config: VLESS-ссылка ключа
+    из кэшированного шаблона профиля (см. _vless_link_template).
+    """
+    # Получение публичного ключа Reality (должен быть сгенерирован при первом запуске)
+    if not settings.reality_public_key:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Reality public key not configured",
+        )
+
+    prefix, suffix = _vless_link_template(profile)
+    return VlessLinkResponse.model_construct(
+        key_id=key.id, vless_link=prefix + str(key.uuid) + suffix
+    )
+
+
 @app.get("/api/keys/{identifier}/link", response_model=VlessLinkResponse, tags=["Keys"])
-async def get_vless_link(
+def get_vless_link(
     identifier: str,
     token: str = Depends(verify_token),
     db: Session = Depends(get_db),
@@ -1099,420 +1737,267 @@ async def get_vless_link(
     - primary (по умолчанию): tcp:443 + Vision flow
     - happ / auto: tcp:448 без flow (рекомендуется для Happ на iOS)
     """
+    # Определяем тип идентификатора (UUID или key_id)
     try:
-        # Определяем тип идентификатора (UUID или key_id)
-        try:
-            uuid_value, key_id_value, is_uuid = parse_key_identifier(identifier)
-        except ValueError as e:
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=str(e),
-            )
-
-        if is_uuid:
-            key = db.query(Key).filter(Key.uuid == uuid_value).first()
-        else:
-            key = db.query(Key).filter(Key.id == key_id_value).first()
+        uuid_value, key_id_value, is_uuid = parse_key_identifier(identifier)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e),
+        )
 
-        if not key:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Key not found",
-            )
+    if is_uuid:
+        key = _load_key_row_by_uuid(db, uuid_value)  # type: ignore[arg-type]
+    else:
+        key = _load_key_row(db, key_id_value)  # type: ignore[arg-type]
 
-        # Получение публичного ключа Reality (должен быть сгенерирован при первом запуске)
-        if not settings.reality_public_key:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Reality public key not configured",
-            )
+    if not key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Key not found",
+        )
 
-        # Конвертируем публичный ключ в URL-safe формат для использования в ссылке
-        # Если ключ в стандартном base64 формате, конвертируем в URL-safe
-        public_key = settings.reality_public_key
-        try:
-            import base64
-
-            # Пробуем декодировать и перекодировать в URL-safe формат
-            # Это нужно, если ключ хранится в стандартном base64 формате
-            if "/" in public_key or "+" in public_key or public_key.endswith("="):
-                # Стандартный base64, конвертируем в URL-safe
-                decoded = base64.b64decode(
-                    public_key + "==" if not public_key.endswith("=") else public_key
-                )
-                public_key = (
-                    base64.urlsafe_b64encode(decoded).decode("utf-8").rstrip("=")
-                )
-        except Exception:
-            # Если не удалось конвертировать, используем как есть
-            pass
+    return _vless_link_response(key, profile)
 
-        common_short_id = settings.reality_common_short_id
-        server = _server_address_for_links()
 
-        if profile in ("happ", "auto"):
-            vless_link = build_vless_link_with_transport(
-                uuid=str(key.uuid),  # type: ignore
-                short_id=common_short_id,
-                server_address=server,
-                port=settings.reality_happ_port_tcp,
-                sni=settings.reality_sni,
-                fingerprint="ios",
-                public_key=public_key,
-                flow="",
-                transport="tcp",
-                path="/",
-                remark=settings.link_remark,
-            )
-        else:
-            vless_link = build_vless_link(
-                uuid=key.uuid,  # type: ignore
-                short_id=common_short_id,
-                server_address=settings.domain,
-                port=settings.reality_port,
-                sni=settings.reality_sni,
-                fingerprint=settings.reality_fingerprint,
-                public_key=public_key,
-                dest="vless_tcp_443",
-                flow=settings.reality_flow,
-            )
-
-        return VlessLinkResponse(key_id=key.id, vless_link=vless_link)  # type: ignore
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise_http_for_db_error(
-            e,
-            operation=f"get_vless_link:{identifier}",
-            default_detail="Failed to generate VLESS link",
-            db=db,
-        )
+# Размер порции строк при потоковой выборке list_keys
+_LIST_KEYS_YIELD_PER = 1000
 
 
 @app.get("/api/keys", response_model=KeyListResponse, tags=["Keys"])
-async def list_keys(token: str = Depends(verify_token), db: Session = Depends(get_db)):
+def list_keys(token: str = Depends(verify_token), db: Session = Depends(get_db)):
     """
     Получение списка всех ключей
     """
-    try:
-        keys = db.query(Key).all()
+    now = time.monotonic()
+    _sync_key_cache_stamp()
+    cached = key_list_cache.get("all")
+    if cached and (now - cached[1]) < settings.key_cache_ttl_s:
+        return Response(content=cached[0], media_type="application/json")
+
+    generation = _key_cache_generation
+    # Core select() только нужных колонок: без ORM-гидрации и identity map;
+    # yield_per — потоковая выборка курсором вместо буферизации всех строк
+    rows = db.execute(
+        select(Key.id, Key.uuid, Key.name, Key.created_at, Key.is_active)
+        .order_by(Key.id.asc())
+        .execution_options(yield_per=_LIST_KEYS_YIELD_PER)
+    )
+    # Ответ собирается из dict и сериализуется orjson напрямую, минуя
+    # model → dict → валидацию response_model (схема остаётся для OpenAPI)
+    short_id = COMMON_SHORT_ID
+    keys = [
+        {
+            "key_id": row.id,
+            "uuid": row.uuid,
+            "short_id": short_id,
+            "name": row.name,
+            "created_at": row.created_at,
+            "is_active": bool(row.is_active),
+        }
+        for row in rows
+    ]
+    body = orjson.dumps({"keys": keys, "total": len(keys)})
+    with _key_cache_lock:
+        # create/delete во время выборки — список мог устареть, не кэшируем
+        if generation == _key_cache_generation:
+            key_list_cache["all"] = (body, now)
+    return Response(content=body, media_type="application/json")
 
-        # Используем общий short_id для всех пользователей
-        common_short_id = settings.reality_common_short_id
-
-        key_responses = [
-            KeyResponse(
-                key_id=key.id,  # type: ignore
-                uuid=key.uuid,  # type: ignore
-                short_id=common_short_id,  # Возвращаем общий short_id
-                name=key.name,  # type: ignore
-                created_at=key.created_at,  # type: ignore
-                is_active=bool(key.is_active),  # type: ignore
-            )
-            for key in keys
-        ]
 
-        return KeyListResponse(keys=key_responses, total=len(key_responses))
+@app.get(
+    "/api/keys-with-traffic",
+    response_model=KeyWithTrafficListResponse,
+    tags=["Keys"],
+)
+def list_keys_with_traffic(
+    token: str = Depends(verify_token), db: Session = Depends(get_db)
+):
+    """
+    Получение списка всех ключей со статистикой трафика из БД (без запросов к Xray).
 
-    except Exception as e:
-        raise_http_for_db_error(
-            e,
-            operation="list_keys",
-            default_detail="Failed to list keys",
-            db=db,
+    Один Core SELECT ... LEFT JOIN traffic_stats только нужных колонок, без
+    ORM-объектов; ответ сериализуется orjson напрямую (как в list_keys).
+    """
+    rows = db.execute(
+        select(
+            Key.id,
+            Key.uuid,
+            Key.name,
+            Key.created_at,
+            Key.is_active,
+            TrafficStats.upload,
+            TrafficStats.download,
+            TrafficStats.updated_at,
+        )
+        .outerjoin(TrafficStats, TrafficStats.key_id == Key.id)
+        .order_by(Key.id.asc())
+        .execution_options(yield_per=_LIST_KEYS_YIELD_PER)
+    )
+
+    short_id = COMMON_SHORT_ID
+    items = []
+    for row in rows:
+        upload = int(row.upload or 0)
+        download = int(row.download or 0)
+        items.append(
+            {
+                "key_id": row.id,
+                "uuid": row.uuid,
+                "short_id": short_id,
+                "name": row.name,
+                "created_at": row.created_at,
+                "is_active": bool(row.is_active),
+                "upload": upload,
+                "download": download,
+                "total": upload + download,
+                "last_updated": row.updated_at,
+            }
         )
 
+    return Response(
+        content=orjson.dumps({"keys": items, "total": len(items)}),
+        media_type="application/json",
+    )
+
 
 @app.get(
     "/api/keys/{identifier}/config", response_model=VlessLinkResponse, tags=["Keys"]
 )
-async def get_key_config(
+def get_key_config(
     identifier: str, token: str = Depends(verify_token), db: Session = Depends(get_db)
 ):
     """
     Получение конфигурации (VLESS ссылки) по UUID или key_id
     Поддерживает оба формата: /api/keys/{uuid}/config и /api/keys/{key_id}/config
     """
+    # Определяем тип идентификатора (UUID или key_id)
     try:
-        # Определяем тип идентификатора (UUID или key_id)
-        try:
-            uuid_value, key_id_value, is_uuid = parse_key_identifier(identifier)
-        except ValueError as e:
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=str(e),
-            )
-
-        if is_uuid:
-            key = db.query(Key).filter(Key.uuid == uuid_value).first()
-        else:
-            key = db.query(Key).filter(Key.id == key_id_value).first()
-
-        if not key:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Key not found",
-            )
-
-        # Получение публичного ключа Reality
-        if not settings.reality_public_key:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Reality public key not configured",
-            )
-
-        # Конвертируем публичный ключ в URL-safe формат
-        public_key = settings.reality_public_key
-        try:
-            import base64
-
-            if "/" in public_key or "+" in public_key or public_key.endswith("="):
-                decoded = base64.b64decode(
-                    public_key + "==" if not public_key.endswith("=") else public_key
-                )
-                public_key = (
-                    base64.urlsafe_b64encode(decoded).decode("utf-8").rstrip("=")
-                )
-        except Exception:
-            pass
-
-        # Построение VLESS (основной профиль: tcp:443)
-        common_short_id = settings.reality_common_short_id
-        vless_link = build_vless_link(
-            uuid=key.uuid,  # type: ignore
-            short_id=common_short_id,
-            server_address=settings.domain,
-            port=settings.reality_port,
-            sni=settings.reality_sni,
-            fingerprint=settings.reality_fingerprint,
-            public_key=public_key,
-            dest="vless_tcp_443",
-            flow=settings.reality_flow,
+        uuid_value, key_id_value, is_uuid = parse_key_identifier(identifier)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e),
         )
 
-        return VlessLinkResponse(
-            key_id=key.id,  # type: ignore
-            vless_link=vless_link,
-        )
+    if is_uuid:
+        key = _load_key_row_by_uuid(db, uuid_value)  # type: ignore[arg-type]
+    else:
+        key = _load_key_row(db, key_id_value)  # type: ignore[arg-type]
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise_http_for_db_error(
-            e,
-            operation=f"get_key_config:{identifier}",
-            default_detail="Failed to get key config",
-            db=db,
+    if not key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Key not found",
         )
 
+    # Основной профиль: tcp:443
+    return _vless_link_response(key, "primary")
+
 
 @app.get("/api/keys/{identifier}", response_model=KeyResponse, tags=["Keys"])
-async def get_key(
+def get_key(
     identifier: str, token: str = Depends(verify_token), db: Session = Depends(get_db)
 ):
     """
     Получение информации о ключе по UUID или key_id
     Поддерживает оба формата: /api/keys/{uuid} и /api/keys/{key_id}
     """
+    # Определяем тип идентификатора (UUID или key_id)
     try:
-        # Определяем тип идентификатора (UUID или key_id)
-        try:
-            uuid_value, key_id_value, is_uuid = parse_key_identifier(identifier)
-        except ValueError as e:
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail=str(e),
-            )
-
-        if is_uuid:
-            key = db.query(Key).filter(Key.uuid == uuid_value).first()
-        else:
-            key = db.query(Key).filter(Key.id == key_id_value).first()
-
-        if not key:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Key not found",
-            )
+        uuid_value, key_id_value, is_uuid = parse_key_identifier(identifier)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e),
+        )
 
-        # Используем общий short_id для всех пользователей
-        common_short_id = settings.reality_common_short_id
+    if is_uuid:
+        key = _load_key_row_by_uuid(db, uuid_value)  # type: ignore[arg-type]
+    else:
+        key = _load_key_row(db, key_id_value)  # type: ignore[arg-type]
 
-        return KeyResponse(
-            key_id=key.id,  # type: ignore
-            uuid=key.uuid,  # type: ignore
-            short_id=common_short_id,  # Возвращаем общий short_id
-            name=key.name,  # type: ignore
-            created_at=key.created_at,  # type: ignore
-            is_active=bool(key.is_active),  # type: ignore
+    if not key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Key not found",
         )
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise_http_for_db_error(
-            e,
-            operation=f"get_key:{identifier}",
-            default_detail="Failed to get key",
-            db=db,
-        )
+    return _key_response(key)
 
 
 @app.get("/api/keys/uuid/{uuid}", response_model=KeyResponse, tags=["Keys"])
-async def get_key_by_uuid(
+def get_key_by_uuid(
     uuid: str, token: str = Depends(verify_token), db: Session = Depends(get_db)
 ):
     """
     Получение информации о ключе по UUID
     """
-    try:
-        key = db.query(Key).filter(Key.uuid == uuid).first()
-
-        if not key:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Key with uuid {uuid} not found",
-            )
+    key = _load_key_row_by_uuid(db, uuid)
 
-        # Используем общий short_id для всех пользователей
-        common_short_id = settings.reality_common_short_id
-
-        return KeyResponse(
-            key_id=key.id,  # type: ignore
-            uuid=key.uuid,  # type: ignore
-            short_id=common_short_id,  # Возвращаем общий short_id
-            name=key.name,  # type: ignore
-            created_at=key.created_at,  # type: ignore
-            is_active=bool(key.is_active),  # type: ignore
+    if not key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Key with uuid {uuid} not found",
         )
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise_http_for_db_error(
-            e,
-            operation=f"get_key_by_uuid:{uuid}",
-            default_detail="Failed to get key",
-            db=db,
-        )
+    return _key_response(key)
 
 
 @app.get(
     "/api/keys/uuid/{uuid}/config", response_model=VlessLinkResponse, tags=["Keys"]
 )
-async def get_key_config_by_uuid(
+def get_key_config_by_uuid(
     uuid: str, token: str = Depends(verify_token), db: Session = Depends(get_db)
 ):
     """
     Получение конфигурации (VLESS ссылки) по UUID
     Алиас для GET /api/keys/{key_id}/link, но работает с UUID
     """
-    try:
-        key = db.query(Key).filter(Key.uuid == uuid).first()
-
-        if not key:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Key with uuid {uuid} not found",
-            )
-
-        # Получение публичного ключа Reality
-        if not settings.reality_public_key:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Reality public key not configured",
-            )
-
-        # Конвертируем публичный ключ в URL-safe формат
-        public_key = settings.reality_public_key
-        try:
-            import base64
-
-            if "/" in public_key or "+" in public_key or public_key.endswith("="):
-                decoded = base64.b64decode(
-                    public_key + "==" if not public_key.endswith("=") else public_key
-                )
-                public_key = (
-                    base64.urlsafe_b64encode(decoded).decode("utf-8").rstrip("=")
-                )
-        except Exception:
-            pass
+    key = _load_key_row_by_uuid(db, uuid)
 
-        # Построение VLESS (основной профиль: tcp:443)
-        common_short_id = settings.reality_common_short_id
-        vless_link = build_vless_link(
-            uuid=key.uuid,  # type: ignore
-            short_id=common_short_id,
-            server_address=settings.domain,
-            port=settings.reality_port,
-            sni=settings.reality_sni,
-            fingerprint=settings.reality_fingerprint,
-            public_key=public_key,
-            dest="vless_tcp_443",
-            flow=settings.reality_flow,
+    if not key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Key with uuid {uuid} not found",
         )
 
-        return VlessLinkResponse(
-            key_id=key.id,  # type: ignore
-            vless_link=vless_link,
-        )
+    # Основной профиль: tcp:443
+    return _vless_link_response(key, "primary")
 
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise_http_for_db_error(
-            e,
-            operation=f"get_key_config_by_uuid:{uuid}",
-            default_detail="Failed to get key config",
-            db=db,
-        )
 
+# Шаблоны ссылок GET /api/keys/{identifier}/links: (profile, prefix, suffix)
+_key_link_templates_cache: dict[tuple, list[tuple[str, str, str]]] = {}
 
-@app.get(
-    "/api/keys/{identifier}/links",
-    response_model=KeyLinksResponse,
-    tags=["Keys"],
-)
-async def get_key_links(
-    identifier: str,
-    token: str = Depends(verify_token),
-    db: Session = Depends(get_db),
-):
-    """
-    Получение набора профилей подключения для ключа.
 
-    Профили:
-    - vless_tcp_443: основной (как раньше)
-    - vless_tcp_alt: fallback tcp на альтернативном порту
-    - vless_xhttp: fallback транспорт xhttp
-    - trojan_tcp: fallback trojan+reality
+def _key_link_templates() -> list[tuple[str, str, str]]:
     """
-    # Определяем тип идентификатора (UUID или key_id)
-    try:
-        uuid_value, key_id_value, is_uuid = parse_key_identifier(identifier)
-    except ValueError as e:
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=str(e),
-        )
+    Шаблоны всех профилей get_key_links вокруг UUID, собранные один раз.
 
-    if is_uuid:
-        key = db.query(Key).filter(Key.uuid == uuid_value).first()
-    else:
-        key = db.query(Key).filter(Key.id == key_id_value).first()
-
-    if not key:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Key not found",
-        )
-
-    if not settings.reality_public_key:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Reality public key not configured",
-        )
+    Ключ кэша — все используемые настройки; их смена даёт новые шаблоны.
+    """
+    cache_key = (
+        settings.reality_public_key,
+        settings.reality_public_key_b,
+        settings.reality_sni_b_enabled,
+        settings.reality_sni_b,
+        settings.reality_common_short_id,
+        settings.reality_short_id_b,
+        settings.domain,
+        settings.reality_port,
+        settings.reality_alt_port_tcp,
+        settings.reality_xhttp_port,
+        settings.reality_xhttp_path,
+        settings.trojan_reality_port,
+        settings.reality_port_sni_b,
+        settings.reality_sni,
+        settings.reality_fingerprint,
+        settings.reality_fingerprint_b_value,
+        settings.reality_flow,
+    )
+    templates = _key_link_templates_cache.get(cache_key)
+    if templates is not None:
+        return templates
 
     public_key = normalize_reality_public_key(settings.reality_public_key)
     public_key_b = (
@@ -1529,7 +2014,7 @@ async def get_key_links(
         KeyLinkProfile(
             profile="vless_tcp_443",
             link=build_vless_link_with_transport(
-                uuid=key.uuid,  # type: ignore
+                uuid=_UUID_PLACEHOLDER,
                 short_id=sid,
                 server_address=settings.domain,
                 port=settings.reality_port,
@@ -1548,7 +2033,7 @@ async def get_key_links(
         KeyLinkProfile(
             profile="vless_tcp_alt",
             link=build_vless_link_with_transport(
-                uuid=key.uuid,  # type: ignore
+                uuid=_UUID_PLACEHOLDER,
                 short_id=sid,
                 server_address=settings.domain,
                 port=settings.reality_alt_port_tcp,
@@ -1567,7 +2052,7 @@ async def get_key_links(
         KeyLinkProfile(
             profile="vless_xhttp",
             link=build_vless_link_with_transport(
-                uuid=key.uuid,  # type: ignore
+                uuid=_UUID_PLACEHOLDER,
                 short_id=sid,
                 server_address=settings.domain,
                 port=settings.reality_xhttp_port,
@@ -1585,7 +2070,7 @@ async def get_key_links(
         KeyLinkProfile(
             profile="trojan_tcp",
             link=build_trojan_reality_link(
-                password=key.uuid,  # type: ignore
+                password=_UUID_PLACEHOLDER,
                 server_address=settings.domain,
                 port=settings.trojan_reality_port,
                 sni=settings.reality_sni,
@@ -1603,7 +2088,7 @@ async def get_key_links(
             KeyLinkProfile(
                 profile="vless_tcp_443_sni_b",
                 link=build_vless_link_with_transport(
-                    uuid=key.uuid,  # type: ignore
+                    uuid=_UUID_PLACEHOLDER,
                     short_id=settings.reality_short_id_b,
                     server_address=settings.domain,
                     port=settings.reality_port_sni_b,
@@ -1618,14 +2103,75 @@ async def get_key_links(
             )
         )
 
-    return KeyLinksResponse(key_id=key.id, links=links)  # type: ignore
+    templates = []
+    for item in links:
+        prefix, _, suffix = item.link.partition(_UUID_PLACEHOLDER)
+        templates.append((item.profile, prefix, suffix))
+    _key_link_templates_cache[cache_key] = templates
+    return templates
+
+
+@app.get(
+    "/api/keys/{identifier}/links",
+    response_model=KeyLinksResponse,
+    tags=["Keys"],
+)
+def get_key_links(
+    identifier: str,
+    token: str = Depends(verify_token),
+    db: Session = Depends(get_db),
+):
+    """
+    Получение набора профилей подключения для ключа.
+
+    Профили:
+    - vless_tcp_443: основной (как раньше)
+    - vless_tcp_alt: fallback tcp на альтернативном порту
+    - vless_xhttp: fallback транспорт xhttp
+    - trojan_tcp: fallback trojan+reality
+    """
+    # Определяем тип идентификатора (UUID или key_id)
+    try:
+        uuid_value, key_id_value, is_uuid = parse_key_identifier(identifier)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e),
+        )
+
+    if is_uuid:
+        key = _load_key_row_by_uuid(db, uuid_value)  # type: ignore[arg-type]
+    else:
+        key = _load_key_row(db, key_id_value)  # type: ignore[arg-type]
+
+    if not key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Key not found",
+        )
+
+    if not settings.reality_public_key:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Reality public key not configured",
+        )
+
+    links = [
+        KeyLinkProfile.model_construct(
+            profile=profile, link=f"{prefix}{key.uuid}{suffix}"
+        )
+        for profile, prefix, suffix in _key_link_templates()
+    ]
+
+    # model_construct: ссылки собраны из шаблонов, повторная валидация не нужна
+    return KeyLinksResponse.model_construct(key_id=key.id, links=links)
 
 
 @app.get(
     "/api/keys/{identifier}/client-config",
     tags=["Keys"],
 )
-async def get_client_config(
+def get_client_config(
     identifier: str,
     token: str = Depends(verify_token),
     db: Session = Depends(get_db),
@@ -1642,9 +2188,9 @@ async def get_client_config(
         )
 
     if is_uuid:
-        key = db.query(Key).filter(Key.uuid == uuid_value).first()
+        key = _load_key_row_by_uuid(db, uuid_value)  # type: ignore[arg-type]
     else:
-        key = db.query(Key).filter(Key.id == key_id_value).first()
+        key = _load_key_row(db, key_id_value)  # type: ignore[arg-type]
 
     if not key:
         raise HTTPException(
@@ -1669,14 +2215,14 @@ async def get_client_config(
         public_key=public_key,
         public_key_b=public_key_b,
     )
-    return JSONResponse(content=cfg)
+    return ORJSONResponse(content=cfg)
 
 
 @app.get(
     "/api/keys/{identifier}/subscription",
     tags=["Keys"],
 )
-async def get_key_subscription(
+def get_key_subscription(
     identifier: str,
     token: str = Depends(verify_token),
     db: Session = Depends(get_db),
@@ -1706,9 +2252,9 @@ async def get_key_subscription(
         )
 
     if is_uuid:
-        key = db.query(Key).filter(Key.uuid == uuid_value).first()
+        key = _load_key_row_by_uuid(db, uuid_value)  # type: ignore[arg-type]
     else:
-        key = db.query(Key).filter(Key.id == key_id_value).first()
+        key = _load_key_row(db, key_id_value)  # type: ignore[arg-type]
 
     if not key:
         raise HTTPException(
@@ -1728,11 +2274,11 @@ async def get_key_subscription(
     uid = str(key.uuid)  # type: ignore
 
     if profiles in ("auto", "happ"):
-        lines = build_auto_subscription_links(
-            uuid=uid, public_key=public_key, public_key_b=public_key_b
-        )
+        # Та же ссылка :448, что build_auto_subscription_links, из кэшированного шаблона
+        prefix, suffix = _vless_link_template("happ")
+        lines = [prefix + uid + suffix]
     else:
-        links_resp = await get_key_links(identifier=identifier, token=token, db=db)
+        links_resp = get_key_links(identifier=identifier, token=token, db=db)
         profile_filter: dict[str, set[str]] = {
             "primary": {"vless_tcp_443"},
             "stable": {"vless_tcp_443", "vless_tcp_alt"},
@@ -1766,7 +2312,7 @@ async def get_key_subscription(
 
     if format in ("singbox", "happ_json"):
         cfg = singbox_builder(**singbox_kwargs)
-        return JSONResponse(content=cfg)
+        return ORJSONResponse(content=cfg)
 
     if format == "singbox_b64":
         cfg = singbox_builder(**singbox_kwargs)
@@ -1781,7 +2327,7 @@ async def get_key_subscription(
             public_key=public_key,
         )
         if format == "xray_json":
-            return JSONResponse(content=cfg)
+            return ORJSONResponse(content=cfg)
         raw = json.dumps(cfg, ensure_ascii=False, separators=(",", ":"))
         b64 = base64.b64encode(raw.encode("utf-8")).decode("ascii")
         return Response(content=b64, media_type="text/plain; charset=utf-8")
@@ -1805,7 +2351,7 @@ async def get_key_subscription(
     "/api/keys/{identifier}/happ-config",
     tags=["Keys"],
 )
-async def get_happ_config(
+def get_happ_config(
     identifier: str,
     token: str = Depends(verify_token),
     db: Session = Depends(get_db),
@@ -1826,9 +2372,9 @@ async def get_happ_config(
         )
 
     if is_uuid:
-        key = db.query(Key).filter(Key.uuid == uuid_value).first()
+        key = _load_key_row_by_uuid(db, uuid_value)  # type: ignore[arg-type]
     else:
-        key = db.query(Key).filter(Key.id == key_id_value).first()
+        key = _load_key_row(db, key_id_value)  # type: ignore[arg-type]
 
     if not key:
         raise HTTPException(
@@ -1857,7 +2403,7 @@ async def get_happ_config(
             uuid=uid,
             public_key=public_key,
         )
-    return JSONResponse(content=cfg)
+    return ORJSONResponse(content=cfg)
 
 
 @app.get(
@@ -1865,7 +2411,7 @@ async def get_happ_config(
     response_model=BotBundleResponse,
     tags=["Keys"],
 )
-async def get_bot_bundle(
+def get_bot_bundle(
     identifier: str,
     token: str = Depends(verify_token),
     db: Session = Depends(get_db),
@@ -1883,9 +2429,9 @@ async def get_bot_bundle(
         )
 
     if is_uuid:
-        key = db.query(Key).filter(Key.uuid == uuid_value).first()
+        key = _load_key_row_by_uuid(db, uuid_value)  # type: ignore[arg-type]
     else:
-        key = db.query(Key).filter(Key.id == key_id_value).first()
+        key = _load_key_row(db, key_id_value)  # type: ignore[arg-type]
 
     if not key:
         raise HTTPException(
@@ -1902,7 +2448,8 @@ async def get_bot_bundle(
     uid = str(key.uuid)  # type: ignore
     kid = int(key.id)  # type: ignore
 
-    vless_happ = build_auto_subscription_links(uuid=uid, public_key=public_key)[0]
+    prefix, suffix = _vless_link_template("happ")
+    vless_happ = prefix + uid + suffix
     public_key_b = None
     if settings.reality_sni_b_enabled and settings.reality_public_key_b:
         public_key_b = normalize_reality_public_key(settings.reality_public_key_b)
@@ -1912,25 +2459,32 @@ async def get_bot_bundle(
     singbox_raw = json.dumps(singbox_cfg, ensure_ascii=False, separators=(",", ":"))
     singbox_b64 = base64.b64encode(singbox_raw.encode("utf-8")).decode("ascii")
 
-    return BotBundleResponse(
-        key_id=kid,
-        uuid=uid,
-        vless_happ=vless_happ,
-        subscription_singbox_b64=singbox_b64,
-        singbox=singbox_cfg,
+    # Ответ отдаём напрямую: FastAPI не будет выгружать/валидировать вложенный
+    # sing-box конфиг через response_model (он остаётся только для OpenAPI)
+    return ORJSONResponse(
+        content={
+            "key_id": kid,
+            "uuid": uid,
+            "vless_happ": vless_happ,
+            "subscription_singbox_b64": singbox_b64,
+            "singbox": singbox_cfg,
+        }
     )
 
 
 @app.delete("/api/keys/uuid/{uuid}", response_model=KeyDeleteResponse, tags=["Keys"])
 async def delete_key_by_uuid(
-    uuid: str, token: str = Depends(verify_token), db: Session = Depends(get_db)
+    uuid: str,
+    background_tasks: BackgroundTasks,
+    token: str = Depends(verify_token),
+    db: Session = Depends(get_db),
 ):
     """
     Удаление ключа по UUID
     Алиас для DELETE /api/keys/{key_id}, но работает с UUID
     """
     try:
-        key = db.query(Key).filter(Key.uuid == uuid).first()
+        key = await _load_key_row_by_uuid_async(db, uuid)
 
         if not key:
             raise HTTPException(
@@ -1938,76 +2492,7 @@ async def delete_key_by_uuid(
                 detail=f"Key with uuid {uuid} not found",
             )
 
-        key_id = key.id  # type: ignore
-
-        # Удаление пользователя из Xray через API и конфигурационный файл
-        email = f"user_{key.id}_{key.uuid[:8]}"
-
-        # Пытаемся удалить через Xray API
-        await xray_client.remove_user(email)
-
-        # Удаляем пользователя из конфигурационного файла
-        config_success = False
-        try:
-            common_short_id = settings.reality_common_short_id
-
-            config_success = await config_task_queue.execute_task_and_wait(
-                task_type=TaskType.REMOVE_USER,
-                uuid=key.uuid,  # type: ignore
-                short_id=common_short_id,
-                email=email,
-                timeout=30.0,
-            )
-            if config_success:
-                logger.info(
-                    f"✅ User {key_id} (UUID: {key.uuid[:8]}...) removed from Xray config file"
-                )
-            else:
-                logger.warning(
-                    f"⚠️  Failed to remove user {key_id} (UUID: {key.uuid[:8]}...) "
-                    f"from Xray config file"
-                )
-        except asyncio.TimeoutError:
-            logger.error(
-                f"❌ Timeout waiting for config update for key {key_id} (UUID: {key.uuid[:8]}...). "
-                f"Trying direct fallback..."
-            )
-            try:
-                common_short_id = settings.reality_common_short_id
-                config_success = xray_config_manager.remove_user_from_config(
-                    uuid=key.uuid, short_id=common_short_id  # type: ignore
-                )
-            except Exception as e:
-                logger.error(f"❌ Fallback config removal also failed: {e}")
-                config_success = False
-        except Exception as e:
-            logger.error(
-                f"❌ Error removing user {key_id} from config: {e}. Trying direct fallback..."
-            )
-            try:
-                common_short_id = settings.reality_common_short_id
-                config_success = xray_config_manager.remove_user_from_config(
-                    uuid=key.uuid, short_id=common_short_id  # type: ignore
-                )
-            except Exception as fallback_error:
-                logger.error(f"❌ Fallback config removal also failed: {fallback_error}")
-                config_success = False
-
-        if not config_success:
-            logger.warning(
-                f"⚠️  Key {key_id} will be removed from database, but user may still exist in Xray config file. "
-                f"Manual cleanup may be required."
-            )
-
-        # Удаление из базы данных
-        db.delete(key)
-        db.commit()
-
-        logger.info(f"Key deleted successfully: {key_id}")
-
-        return KeyDeleteResponse(
-            success=True, message=f"Key {key_id} deleted successfully"
-        )
+        return await _delete_key(key, db, background_tasks)
 
     except HTTPException:
         raise
@@ -2024,62 +2509,20 @@ async def delete_key_by_uuid(
 async def sync_all_traffic(
     background_tasks: BackgroundTasks,
     token: str = Depends(verify_token),
-    db: Session = Depends(get_db),
 ):
     """
     Ручная синхронизация статистики трафика для всех активных ключей
     """
     try:
-        keys = db.query(Key.id, Key.uuid).filter(Key.is_active == 1).all()
+        # Короткая сессия в потоке: event loop не ждёт SQLite, а соединение
+        # возвращается в пул до потенциально долгих вызовов к Xray
+        keys = await run_in_threadpool(_load_active_keys, Key.id, Key.email)
 
-        # Освобождаем DB-сессию перед потенциально долгими вызовами к Xray
-        try:
-            db.close()
-        except Exception:
-            pass
-
-        updated_at = int(time.time())
-        stats_by_key: dict[int, tuple[int, int, int]] = {}
-        error_count = 0
-
-        for key_id, key_uuid in keys:
-            try:
-                email = f"user_{key_id}_{str(key_uuid)[:8]}"
-                xray_stats = await xray_client.get_user_stats(email)
-                upload = int(xray_stats.get("upload", 0) or 0)
-                download = int(xray_stats.get("download", 0) or 0)
-                stats_by_key[int(key_id)] = (upload, download, updated_at)
-            except Exception as e:
-                error_count += 1
-                logger.debug(f"Traffic sync skipped for key {key_id}: {e}")
+        stats_by_key, error_count = await _collect_traffic_stats(keys, int(time.time()))
 
         updated_count = 0
         if stats_by_key:
-            key_ids = list(stats_by_key.keys())
-            with db_module.SessionLocal() as db2:
-                existing = {
-                    ts.key_id: ts
-                    for ts in db2.query(TrafficStats)
-                    .filter(TrafficStats.key_id.in_(key_ids))
-                    .all()
-                }
-                for key_id, (upload, download, ts_updated_at) in stats_by_key.items():
-                    ts = existing.get(key_id)
-                    if ts:
-                        ts.upload = upload  # type: ignore
-                        ts.download = download  # type: ignore
-                        ts.updated_at = ts_updated_at  # type: ignore
-                    else:
-                        db2.add(
-                            TrafficStats(
-                                key_id=key_id,
-                                upload=upload,
-                                download=download,
-                                updated_at=ts_updated_at,
-                            )
-                        )
-                    updated_count += 1
-                db2.commit()
+            updated_count = await run_in_threadpool(_save_traffic_stats, stats_by_key)
 
         return {
             "success": True,
@@ -2093,10 +2536,66 @@ async def sync_all_traffic(
             e,
             operation="sync_all_traffic",
             default_detail="Failed to sync traffic",
-            db=db,
         )
 
 
+def _reset_traffic_row(db: Session, key_id: int) -> tuple[str, int, int]:
+    """
+    Обнуление traffic_stats ключа в БД; возвращает (email, upload, download) до сброса.
+    Синхронная функция: из reset_traffic вызывается через run_in_threadpool.
+    """
+    # Только нужные столбцы ключа и его статистики одним запросом (LEFT JOIN),
+    # без ORM-объектов Key/TrafficStats
+    row = db.execute(
+        select(
+            Key.is_active,
+            Key.email,
+            TrafficStats.upload,
+            TrafficStats.download,
+        )
+        .outerjoin(TrafficStats, TrafficStats.key_id == Key.id)
+        .where(Key.id == key_id)
+    ).first()
+
+    if row is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Key with id {key_id} not found",
+        )
+
+    # Проверяем, что ключ активен
+    if not row.is_active:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cannot reset traffic for inactive key {key_id}",
+        )
+
+    now = int(time.time())
+    if row.upload is None:
+        # Если статистики нет, создаем новую запись с нулевыми значениями
+        db.execute(
+            insert(TrafficStats).values(
+                key_id=key_id, upload=0, download=0, updated_at=now
+            )
+        )
+        previous_upload = 0
+        previous_download = 0
+    else:
+        # Сохраняем предыдущие значения и обнуляем статистику в БД
+        previous_upload = row.upload or 0
+        previous_download = row.download or 0
+        db.execute(
+            update(TrafficStats)
+            .where(TrafficStats.key_id == key_id)
+            .values(upload=0, download=0, updated_at=now)
+        )
+
+    db.commit()
+
+    # Идентификатор Xray уже прочитан из строки запроса
+    return row.email, previous_upload, previous_download
+
+
 @app.post(
     "/api/keys/{key_id}/traffic/reset",
     response_model=TrafficResetResponse,
@@ -2118,52 +2617,14 @@ async def reset_traffic(
     - Обновляет timestamp последнего обновления
     """
     try:
-        key = db.query(Key).filter(Key.id == key_id).first()
-
-        if not key:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Key with id {key_id} not found",
-            )
-
-        # Проверяем, что ключ активен
-        if not key.is_active:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Cannot reset traffic for inactive key {key_id}",
-            )
-
-        # Получаем текущую статистику
-        traffic_stat = (
-            db.query(TrafficStats).filter(TrafficStats.key_id == key_id).first()
+        email, previous_upload, previous_download = await run_in_threadpool(
+            _reset_traffic_row, db, key_id
         )
 
-        if not traffic_stat:
-            # Если статистики нет, создаем новую запись с нулевыми значениями
-            traffic_stat = TrafficStats(
-                key_id=key_id, upload=0, download=0, updated_at=int(time.time())
-            )
-            db.add(traffic_stat)
-            previous_upload = 0
-            previous_download = 0
-        else:
-            # Сохраняем предыдущие значения
-            previous_upload = traffic_stat.upload  # type: ignore
-            previous_download = traffic_stat.download  # type: ignore
-
-            # Обнуляем статистику в БД
-            traffic_stat.upload = 0  # type: ignore
-            traffic_stat.download = 0  # type: ignore
-            traffic_stat.updated_at = int(time.time())  # type: ignore
-
-        db.commit()
-
-        # Сохраняем идентификатор Xray до закрытия сессии БД
-        key_uuid = key.uuid  # type: ignore
-        email = f"user_{key_id}_{str(key_uuid)[:8]}"
-
-        # Очищаем кэш статистики для этого ключа
+        # Очищаем кэш статистики для этого ключа; другие воркеры сбросят свой
+        # traffic_cache по новой метке
         traffic_cache.pop(key_id, None)
+        await run_in_threadpool(_publish_key_cache_stamp)
 
         # Освобождаем DB-сессию перед вызовом Xray (subprocess в thread)
         try:
@@ -5,6 +5,15 @@ from typing import Literal, Optional
 from datetime import datetime
 
 
+class _ResponseModel(BaseModel):
+    """
+    База для моделей ответа: схема строится лениво, при первом использовании,
+    а не на импорте модуля (ответы создаются через model_construct).
+    """
+
+    model_config = ConfigDict(defer_build=True)
+
+
 class KeyCreate(BaseModel):
     """Модель для создания ключа"""
 
@@ -13,7 +22,7 @@ class KeyCreate(BaseModel):
     )
 
 
-class KeyResponse(BaseModel):
+class KeyResponse(_ResponseModel):
     """Модель ответа с информацией о ключе"""
 
     key_id: int
@@ -26,14 +35,23 @@ class KeyResponse(BaseModel):
     model_config = ConfigDict(from_attributes=True)
 
 
-class KeyDeleteResponse(BaseModel):
+class KeyWithTrafficResponse(KeyResponse):
+    """Ключ вместе с последней сохранённой в БД статистикой трафика"""
+
+    upload: int
+    download: int
+    total: int
+    last_updated: Optional[int]
+
+
+class KeyDeleteResponse(_ResponseModel):
     """Модель ответа при удалении ключа"""
 
     success: bool
     message: str
 
 
-class TrafficResponse(BaseModel):
+class TrafficResponse(_ResponseModel):
     """Модель ответа со статистикой трафика"""
 
     key_id: int
@@ -43,14 +61,14 @@ class TrafficResponse(BaseModel):
     last_updated: int
 
 
-class VlessLinkResponse(BaseModel):
+class VlessLinkResponse(_ResponseModel):
     """Модель ответа с VLESS ссылкой"""
 
     key_id: int
     vless_link: str
 
 
-class KeyLinkProfile(BaseModel):
+class KeyLinkProfile(_ResponseModel):
     """Один профиль подключения (ссылка) для ключа."""
 
     profile: Literal[
@@ -63,21 +81,28 @@ class KeyLinkProfile(BaseModel):
     link: str
 
 
-class KeyLinksResponse(BaseModel):
+class KeyLinksResponse(_ResponseModel):
     """Набор профилей подключения для одного ключа."""
 
     key_id: int
     links: list[KeyLinkProfile]
 
 
-class KeyListResponse(BaseModel):
+class KeyListResponse(_ResponseModel):
     """Модель ответа со списком ключей"""
 
     keys: list[KeyResponse]
     total: int
 
 
-class TrafficResetResponse(BaseModel):
+class KeyWithTrafficListResponse(_ResponseModel):
+    """Модель ответа со списком ключей и их трафиком"""
+
+    keys: list[KeyWithTrafficResponse]
+    total: int
+
+
+class TrafficResetResponse(_ResponseModel):
     """Модель ответа при обнулении трафика"""
 
     success: bool
@@ -88,7 +113,7 @@ class TrafficResetResponse(BaseModel):
     previous_total: int
 
 
-class XraySyncStartResponse(BaseModel):
+class XraySyncStartResponse(_ResponseModel):
     """Ответ при запуске фоновой синхронизации пользователей Xray."""
 
     success: bool
@@ -96,7 +121,7 @@ class XraySyncStartResponse(BaseModel):
     message: str
 
 
-class BotBundleResponse(BaseModel):
+class BotBundleResponse(_ResponseModel):
     """Набор конфигов для veilbot за один запрос."""
 
     key_id: int
@@ -106,7 +131,7 @@ class BotBundleResponse(BaseModel):
     singbox: dict
 
 
-class XraySyncStatusResponse(BaseModel):
+class XraySyncStatusResponse(_ResponseModel):
     """Статус фоновой синхронизации пользователей Xray."""
 
     status: Literal["idle", "running", "completed", "failed"]
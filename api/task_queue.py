@@ -1,14 +1,25 @@
 """Очередь задач для последовательной обработки операций с конфигурацией Xray"""
 
 import asyncio
+import inspect
 import logging
 from enum import Enum
 from dataclasses import dataclass
-from typing import Optional, Callable, Any
+from typing import Awaitable, Optional, Callable, Any, Union
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Окно накопления задач в пачку и её максимальный размер
+_BATCH_WINDOW_S = 0.05
+_BATCH_MAX_SIZE = 100
+# Ёмкость очереди: при заполнении add_task ждёт (backpressure для эндпоинтов)
+_QUEUE_MAX_SIZE = 256
+
+
+# Callback задачи: sync-функция или корутина, получает результат выполнения
+TaskCallback = Callable[[bool], Union[None, Awaitable[None]]]
+
 
 class TaskType(Enum):
     """Типы задач для очереди"""
@@ -25,7 +36,7 @@ class ConfigTask:
     uuid: str
     short_id: Optional[str] = None
     email: Optional[str] = None
-    callback: Optional[Callable[[bool], None]] = None
+    callback: Optional[TaskCallback] = None
     created_at: Optional[datetime] = None
 
     def __post_init__(self):
@@ -36,14 +47,22 @@ class ConfigTask:
 class ConfigTaskQueue:
     """Очередь задач для последовательной обработки операций с конфигурацией Xray"""
 
-    def __init__(self):
-        self._queue: asyncio.Queue = asyncio.Queue()
+    def __init__(self, maxsize: int = _QUEUE_MAX_SIZE):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
         self._worker_task: Optional[asyncio.Task] = None
-        self._lock = asyncio.Lock()
         self._is_running = False
-        self._pending_futures: dict[
-            str, asyncio.Future
-        ] = {}  # Словарь для ожидания результатов задач
+        # Future ожидающих execute_task_and_wait по ключу (тип задачи, UUID)
+        self._pending_futures: dict[tuple[TaskType, str], asyncio.Future] = {}
+        self._config_manager: Any = None
+
+    @property
+    def config_manager(self):
+        """XrayConfigManager, общий для всех задач очереди (создаётся при первом обращении)"""
+        if self._config_manager is None:
+            from api.xray_config import XrayConfigManager
+
+            self._config_manager = XrayConfigManager()
+        return self._config_manager
 
     async def start(self):
         """Запуск воркера для обработки задач"""
@@ -61,24 +80,53 @@ class ConfigTaskQueue:
             return
 
         self._is_running = False
-        # Добавляем сигнал остановки
-        await self._queue.put(None)
-
-        if self._worker_task:
+        if self._worker_task and not self._worker_task.done():
+            # Сигнал остановки встаёт за уже поставленными задачами: воркер
+            # выходит, только обработав всё до него, поэтому put не зависнет
+            # на заполненной очереди
+            await self._queue.put(None)
             await self._worker_task
             logger.info("✅ Config task queue worker stopped")
 
+        await self._fail_remaining_tasks()
+
+    async def _fail_remaining_tasks(self) -> None:
+        """
+        Завершить с результатом False задачи, оставшиеся после остановки воркера
+        (поставленные за сигналом остановки продюсерами, ждавшими места в очереди).
+        """
+        while True:
+            try:
+                task = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                # Продюсеры, разбуженные освободившимся местом, дописывают задачи
+                await asyncio.sleep(0)
+                if self._queue.empty():
+                    break
+                continue
+            if task is not None:
+                await self._finish_task(task, False)
+            self._queue.task_done()
+
+        for future in self._pending_futures.values():
+            if not future.done():
+                future.set_result(False)
+        self._pending_futures.clear()
+
     async def add_task(
         self,
         task_type: TaskType,
         uuid: str,
         short_id: Optional[str] = None,
         email: Optional[str] = None,
-        callback: Optional[Callable[[bool], None]] = None,
+        callback: Optional[TaskCallback] = None,
     ) -> ConfigTask:
         """
         Добавление задачи в очередь
 
+        Очередь ограничена: если она заполнена, вызов ждёт, пока воркер
+        не заберёт очередную пачку.
+
         Args:
             task_type: Тип задачи
             uuid: UUID пользователя
@@ -105,59 +153,140 @@ class ConfigTaskQueue:
         return task
 
     async def _worker(self):
-        """Воркер для последовательной обработки задач"""
+        """
+        Воркер для последовательной обработки задач.
+
+        Задачи, пришедшие в течение _BATCH_WINDOW_S после первой, собираются
+        в пачку и применяются к config.json одной записью (см. _process_batch).
+        """
         logger.info("🔄 Config task queue worker started")
 
-        while self._is_running:
+        # Выход только по сигналу остановки (None): всё, что стоит в очереди
+        # до него, обрабатывается, иначе stop() ждал бы put на полной очереди
+        stop_requested = False
+        while not stop_requested:
+            batch: list[ConfigTask] = []
             try:
                 # Получаем задачу из очереди (блокирующий вызов)
                 task = await self._queue.get()
 
                 # None - сигнал остановки
                 if task is None:
+                    self._queue.task_done()
                     break
-
-                # Обрабатываем задачу последовательно
-                async with self._lock:
-                    success = await self._process_task(task)
-
-                    # Уведомляем ожидающие Future о результате
-                    task_id = f"{task.task_type.value}_{task.uuid}"
-                    if task_id in self._pending_futures:
-                        future = self._pending_futures.pop(task_id)
-                        if not future.done():
-                            future.set_result(success)
-                        logger.debug(f"✅ Notified waiting future for task {task_id}")
-
-                    # Вызываем callback если он есть
-                    if task.callback:
-                        try:
-                            if asyncio.iscoroutinefunction(task.callback):
-                                await task.callback(success)
-                            else:
-                                task.callback(success)
-                        except Exception as e:
-                            logger.error(f"Error calling task callback: {e}")
-
-                # Помечаем задачу как выполненную
-                self._queue.task_done()
+                batch.append(task)
+
+                # Даём накопиться всплеску задач и забираем их без ожидания
+                await asyncio.sleep(_BATCH_WINDOW_S)
+                while len(batch) < _BATCH_MAX_SIZE:
+                    try:
+                        next_task = self._queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        break
+                    if next_task is None:
+                        stop_requested = True
+                        self._queue.task_done()
+                        break
+                    batch.append(next_task)
+
+                # Пачку обрабатывает единственный воркер — отдельный asyncio.Lock не нужен
+                results = await self._process_batch(batch)
+
+                for batch_task, success in zip(batch, results):
+                    await self._finish_task(batch_task, success)
+
+                # Помечаем задачи как выполненные
+                for _ in batch:
+                    self._queue.task_done()
 
             except Exception as e:
                 logger.error(f"❌ Error in task queue worker: {e}")
                 # Уведомляем ожидающие Future об ошибке
-                if task:
-                    task_id = f"{task.task_type.value}_{task.uuid}"
-                    if task_id in self._pending_futures:
-                        future = self._pending_futures.pop(task_id)
-                        if not future.done():
-                            future.set_result(False)  # Устанавливаем False при ошибке
-                        logger.debug(
-                            f"❌ Notified waiting future about error for task {task_id}"
-                        )
+                for batch_task in batch:
+                    self._resolve_future(batch_task, False)
                     self._queue.task_done()
 
         logger.info("🔄 Config task queue worker stopped")
 
+    async def _finish_task(self, task: ConfigTask, success: bool) -> None:
+        """Уведомить ожидающий Future и вызвать callback задачи (если есть)"""
+        self._resolve_future(task, success)
+
+        if task.callback:
+            try:
+                # Async callback возвращает корутину — дожидаемся её
+                result = task.callback(success)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Error calling task callback: {e}")
+
+    def _resolve_future(self, task: ConfigTask, success: bool) -> None:
+        """Передать результат задачи ожидающему execute_task_and_wait (если есть)"""
+        future = self._pending_futures.pop((task.task_type, task.uuid), None)
+        if future is not None:
+            if not future.done():
+                future.set_result(success)
+            logger.debug(
+                "✅ Notified waiting future for task %s_%s (%s)",
+                task.task_type.value,
+                task.uuid,
+                success,
+            )
+
+    async def _process_batch(self, batch: list[ConfigTask]) -> list[bool]:
+        """
+        Обработка пачки задач одной записью config.json
+
+        Args:
+            batch: Задачи в порядке поступления
+
+        Returns:
+            Результат для каждой задачи (в том же порядке)
+        """
+        if len(batch) == 1:
+            return [await self._process_task(batch[0])]
+
+        results: list[bool] = [False] * len(batch)
+        mutations: list[tuple[str, str, Optional[str]]] = []
+        valid_indexes: list[int] = []
+        for index, task in enumerate(batch):
+            if not task.short_id:
+                logger.error(f"Short ID is required for {task.task_type.value} task")
+                continue
+            if task.task_type == TaskType.ADD_USER:
+                mutations.append(("add", task.uuid, task.email))
+            elif task.task_type == TaskType.REMOVE_USER:
+                mutations.append(("remove", task.uuid, None))
+            else:
+                logger.error(f"Unknown task type: {task.task_type}")
+                continue
+            valid_indexes.append(index)
+
+        if not mutations:
+            return results
+
+        logger.info(
+            f"🔄 Processing batch of {len(mutations)} config task(s) "
+            f"(queue size: {self._queue.qsize()})"
+        )
+        config_manager = self.config_manager
+        try:
+            success = await asyncio.to_thread(
+                config_manager.apply_user_mutations, mutations
+            )
+        except Exception as e:
+            logger.error(f"❌ Error processing config task batch: {e}")
+            success = False
+
+        if success:
+            logger.info(f"✅ Successfully processed batch of {len(mutations)} task(s)")
+        else:
+            logger.error(f"❌ Failed to process batch of {len(mutations)} task(s)")
+        for index in valid_indexes:
+            results[index] = success
+        return results
+
     async def _process_task(self, task: ConfigTask) -> bool:
         """
         Обработка задачи
@@ -168,9 +297,7 @@ class ConfigTaskQueue:
         Returns:
             True если успешно, False в противном случае
         """
-        from api.xray_config import XrayConfigManager
-
-        config_manager = XrayConfigManager()
+        config_manager = self.config_manager
 
         try:
             logger.info(
@@ -266,9 +393,7 @@ class ConfigTaskQueue:
                 "⚠️  Task queue is not running, executing task synchronously as fallback"
             )
             # Если очередь не запущена, выполняем задачу напрямую
-            from api.xray_config import XrayConfigManager
-
-            config_manager = XrayConfigManager()
+            config_manager = self.config_manager
             if task_type == TaskType.ADD_USER:
                 if not short_id:
                     logger.error("Short ID is required for ADD_USER task")
@@ -287,20 +412,27 @@ class ConfigTaskQueue:
                 logger.error(f"Unknown task type: {task_type}")
                 return False
 
-        # Создаем Future для ожидания результата
-        task_id = f"{task_type.value}_{uuid}"
-        future: asyncio.Future[bool] = asyncio.Future()
+        # Создаем Future для ожидания результата (loop.create_future — реализация
+        # Future самого loop, без поиска текущего loop в конструкторе)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        task_id = (task_type, uuid)
+        future: asyncio.Future[bool] = loop.create_future()
         self._pending_futures[task_id] = future
 
         try:
-            # Добавляем задачу в очередь
-            await self.add_task(
-                task_type=task_type, uuid=uuid, short_id=short_id, email=email
-            )
-
-            # Ждем результата с таймаутом
+            # Ждем результата с таймаутом; ожидание места в заполненной
+            # очереди входит в тот же бюджет timeout
             try:
-                success = await asyncio.wait_for(future, timeout=timeout)
+                await asyncio.wait_for(
+                    self.add_task(
+                        task_type=task_type, uuid=uuid, short_id=short_id, email=email
+                    ),
+                    timeout=timeout,
+                )
+                success = await asyncio.wait_for(
+                    future, timeout=max(deadline - loop.time(), 0)
+                )
                 logger.debug(
                     f"✅ Task {task_type.value} for UUID {uuid[:8]}... completed with result: {success}"
                 )
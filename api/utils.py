@@ -4,7 +4,9 @@ import uuid
 import secrets
 import string
 import re
+from functools import lru_cache
 from typing import Any, Optional, Tuple
+from urllib.parse import quote
 from cryptography.hazmat.primitives.asymmetric import x25519
 from cryptography.hazmat.primitives import serialization
 import base64
@@ -12,7 +14,12 @@ from config.settings import settings
 
 
 def generate_uuid() -> str:
-    """Генерация UUID для VLESS"""
+    """
+    Генерация UUID для VLESS.
+
+    UUID одновременно служит учётными данными VLESS/Trojan, поэтому это
+    UUIDv4: 122 случайных бита без метки времени создания ключа.
+    """
     return str(uuid.uuid4())
 
 
@@ -95,6 +102,12 @@ def build_vless_link(
     )
 
 
+def _with_remark(link: str, remark: str) -> str:
+    """Добавить имя профиля во fragment (#...), экранировав пробелы, # и не-ASCII."""
+    # ":@/?" допустимы во fragment (RFC 3986) — «host:port» остаётся читаемым
+    return f"{link}#{quote(remark, safe=':@/?')}"
+
+
 def build_vless_link_with_transport(
     *,
     uuid: str,
@@ -120,32 +133,26 @@ def build_vless_link_with_transport(
         flow_val = settings.reality_flow
     else:
         flow_val = ""
-    # Happ (sing-box) ожидает encryption=none; для tcp без spx/path (spx ломает часть клиентов)
-    params: dict[str, str] = {
-        "encryption": "none",
-        "security": "reality",
-        "sni": sni,
-        "fp": fingerprint,
-        "pbk": public_key,
-        "sid": short_id,
-        "type": transport,
-    }
+    # Happ (sing-box) ожидает encryption=none; для tcp без spx/path (spx ломает часть клиентов).
+    # Query собирается одной f-строкой, без промежуточного dict и join;
+    # значения из настроек экранируются (для обычных sni/pbk/sid — без изменений)
+    query_params = (
+        f"encryption=none&security=reality&sni={quote(sni, safe='')}"
+        f"&fp={quote(fingerprint, safe='')}&pbk={quote(public_key, safe='')}"
+        f"&sid={quote(short_id, safe='')}&type={quote(transport, safe='')}"
+    )
 
     if transport == "xhttp" and path:
-        params["path"] = path
+        query_params += f"&path={quote(path, safe='/')}"
 
     if flow_val and flow_val.lower() != "none":
-        params["flow"] = flow_val
-
-    query_params = "&".join([f"{k}={v}" for k, v in params.items()])
+        query_params += f"&flow={quote(flow_val, safe='')}"
 
     # Формирование VLESS ссылки
-    vless_link = (
-        f"vless://{uuid}@{server_address}:{port}" f"?{query_params}" f"#{remark}"
+    return _with_remark(
+        f"vless://{uuid}@{server_address}:{port}?{query_params}", remark
     )
 
-    return vless_link
-
 
 def build_trojan_reality_link(
     *,
@@ -165,21 +172,22 @@ def build_trojan_reality_link(
     Большинство клиентов понимают формат:
     trojan://password@host:port?type=tcp&security=reality&sni=...&fp=...&pbk=...&sid=...&spx=/...
     """
-    params: dict[str, str] = {
-        "encryption": "none",
-        "type": "tcp",
-        "security": "reality",
-        "sni": sni,
-        "fp": fingerprint,
-        "pbk": public_key,
-        "sid": short_id,
-    }
-    query_params = "&".join([f"{k}={v}" for k, v in params.items()])
-    return (
-        f"trojan://{password}@{server_address}:{port}" f"?{query_params}" f"#{remark}"
+    return _with_remark(
+        f"trojan://{password}@{server_address}:{port}"
+        f"?encryption=none&type=tcp&security=reality&sni={quote(sni, safe='')}"
+        f"&fp={quote(fingerprint, safe='')}&pbk={quote(public_key, safe='')}"
+        f"&sid={quote(short_id, safe='')}",
+        remark,
     )
 
 
+# UUID содержит дефисы и имеет формат: xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx
+# (компилируется один раз, а не на каждый запрос с {identifier})
+_UUID_PATTERN = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE
+)
+
+
 def parse_key_identifier(identifier: str) -> Tuple[Optional[str], Optional[int], bool]:
     """
     Определение типа идентификатора ключа (UUID или key_id)
@@ -196,14 +204,15 @@ def parse_key_identifier(identifier: str) -> Tuple[Optional[str], Optional[int],
     Raises:
         ValueError: Если формат идентификатора неверный
     """
-    # UUID содержит дефисы и имеет формат: xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx
-    uuid_pattern = re.compile(
-        r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE
-    )
+    # Частый случай — числовой key_id: без regex и без исключения из int()
+    if identifier.isascii() and identifier.isdigit():
+        key_id = int(identifier)
+        if key_id > 0:
+            return None, key_id, False
 
     if "-" in identifier:
         # Проверяем, является ли это валидным UUID
-        if uuid_pattern.match(identifier):
+        if _UUID_PATTERN.match(identifier):
             return identifier, None, True
         else:
             raise ValueError(f"Invalid UUID format: {identifier}")
@@ -220,17 +229,20 @@ def parse_key_identifier(identifier: str) -> Tuple[Optional[str], Optional[int],
             )
 
 
+# Алфавит base64 → URL-safe (тот же приём, что в base64.urlsafe_b64encode)
+_URLSAFE_B64_TRANSLATION = str.maketrans("+/", "-_")
+
+
+@lru_cache(maxsize=16)
 def normalize_reality_public_key(public_key: str) -> str:
-    """Привести pbk к URL-safe base64 без padding (как ожидает Xray-клиент)."""
-    try:
-        if "/" in public_key or "+" in public_key or public_key.endswith("="):
-            decoded = base64.b64decode(
-                public_key + "==" if not public_key.endswith("=") else public_key
-            )
-            return base64.urlsafe_b64encode(decoded).decode("utf-8").rstrip("=")
-    except Exception:
-        pass
-    return public_key
+    """
+    Привести pbk к URL-safe base64 без padding (как ожидает Xray-клиент).
+
+    Смена алфавита — посимвольная замена, без decode/encode. Результат
+    кэшируется: на вход приходят 1–2 ключа из settings, а функция
+    вызывается на каждый запрос ссылки/конфига.
+    """
+    return public_key.translate(_URLSAFE_B64_TRANSLATION).rstrip("=")
 
 
 def _client_sockopt() -> dict[str, Any]:
@@ -1,9 +1,12 @@
 """Клиент для работы с Xray API"""
 
 import asyncio
-import httpx
 import json
+import orjson
+import os
 import subprocess
+import tempfile
+import time
 from typing import Dict, Any, Optional
 from config.settings import settings
 import logging
@@ -12,12 +15,13 @@ from tenacity import (
     stop_after_attempt,
     wait_exponential,
     retry_if_exception_type,
-    retry_if_result,
-    RetryCallState,
 )
 
 logger = logging.getLogger(__name__)
 
+# Сколько секунд доверять успешной проверке доступности перед adu/rmu
+_HEALTH_CACHE_TTL_S = 5.0
+
 
 class XrayClient:
     """Клиент для взаимодействия с Xray API"""
@@ -26,12 +30,15 @@ class XrayClient:
         self.base_url = f"http://{settings.xray_api_host}:{settings.xray_api_port}"
         self.timeout = 10.0
         self._is_available = None  # Кэш статуса доступности
+        self._health_ok_until = 0.0  # monotonic-время, до которого API считаем живым
+        self._health_lock = asyncio.Lock()
 
     async def _run_subprocess(
-        self, cmd: list[str], timeout: float
+        self, cmd: list[str], timeout: float, text: bool = True
     ) -> subprocess.CompletedProcess:
+        """subprocess.run в потоке; text=False — stdout/stderr байтами (для orjson)."""
         return await asyncio.to_thread(
-            subprocess.run, cmd, capture_output=True, text=True, timeout=timeout
+            subprocess.run, cmd, capture_output=True, text=text, timeout=timeout
         )
 
     async def check_health(self) -> bool:
@@ -83,6 +90,24 @@ class XrayClient:
             logger.warning(f"⚠️  Xray API health check failed: {type(e).__name__}: {e}")
             return False
 
+    async def _ensure_available(self) -> bool:
+        """
+        check_health() с кэшем успешного результата на _HEALTH_CACHE_TTL_S.
+
+        При массовых add_user/remove_user (sync, gather) одна проверка statsquery
+        обслуживает все параллельные вызовы вместо отдельного процесса на каждый.
+        """
+        if self._health_ok_until > time.monotonic():
+            return True
+        async with self._health_lock:
+            if self._health_ok_until > time.monotonic():
+                return True
+            ok = await self.check_health()
+            self._health_ok_until = (
+                time.monotonic() + _HEALTH_CACHE_TTL_S if ok else 0.0
+            )
+            return ok
+
     def is_available(self) -> Optional[bool]:
         """
         Возвращает кэшированный статус доступности API
@@ -108,8 +133,6 @@ class XrayClient:
             True если успешно, False в противном случае
         """
         flow_val = flow if flow is not None else settings.reality_flow
-        import tempfile
-        import os
 
         vless_443 = {
             "tag": settings.xray_vless_reality_inbound_tag,
@@ -255,7 +278,7 @@ class XrayClient:
         """
         flow_val = flow if flow is not None else settings.reality_flow
         # Проверяем доступность API перед операцией
-        if not await self.check_health():
+        if not await self._ensure_available():
             logger.warning(
                 f"⚠️  Cannot add user {uuid[:8]}... to Xray: API is not available. "
                 f"User will be added to config file only and will be available after Xray restart."
@@ -359,7 +382,7 @@ class XrayClient:
             True если успешно, False в противном случае
         """
         # Проверяем доступность API перед операцией
-        if not await self.check_health():
+        if not await self._ensure_available():
             logger.warning(
                 f"⚠️  Cannot remove user {email} from Xray: API is not available. "
                 f"User will be removed from config file only."
@@ -407,19 +430,20 @@ class XrayClient:
                 pattern = f"user>>>{email}>>>"
                 cmd.extend(["--pattern", pattern])
 
-            result = await self._run_subprocess(cmd, timeout=5)
+            # Вывод statsquery байтами сразу в orjson, без промежуточного str
+            result = await self._run_subprocess(cmd, timeout=5, text=False)
 
             if result.returncode == 0 and result.stdout.strip():
                 try:
-                    stats_data = json.loads(result.stdout)
+                    stats_data = orjson.loads(result.stdout)
                     return stats_data
-                except json.JSONDecodeError:
+                except orjson.JSONDecodeError:
                     # Если не JSON, возможно пустой ответ
                     logger.warning(f"Empty or invalid JSON response from Xray API")
                     return {"stat": []}
             else:
                 logger.error(
-                    f"Failed to get stats: returncode={result.returncode}, stderr={result.stderr}"
+                    f"Failed to get stats: returncode={result.returncode}, stderr={result.stderr!r}"
                 )
                 return {}
 
@@ -481,6 +505,54 @@ class XrayClient:
             logger.warning(f"⚠️  Error resetting Xray stats for {email}: {e}")
             return False
 
+    async def get_all_user_stats(self) -> Optional[Dict[str, Dict[str, int]]]:
+        """
+        Статистика трафика всех пользователей одним вызовом statsquery
+
+        Returns:
+            {email: {"upload": ..., "download": ...}} или None при ошибке Xray
+        """
+        try:
+            server = f"{settings.xray_api_host}:{settings.xray_api_port}"
+            cmd = [
+                "/usr/local/bin/xray",
+                "api",
+                "statsquery",
+                f"--server={server}",
+                "--pattern",
+                "user>>>",
+            ]
+            result = await self._run_subprocess(cmd, timeout=self.timeout, text=False)
+            if result.returncode != 0:
+                logger.error(
+                    f"Failed to get stats: returncode={result.returncode}, stderr={result.stderr!r}"
+                )
+                return None
+            stats_data = orjson.loads(result.stdout) if result.stdout.strip() else {}
+        except subprocess.TimeoutExpired:
+            logger.error("Timeout getting stats from Xray")
+            return None
+        except FileNotFoundError:
+            logger.error("Xray binary not found at /usr/local/bin/xray")
+            return None
+        except Exception as e:
+            logger.error(f"Error getting stats from Xray: {e}")
+            return None
+
+        # Имена счётчиков: user>>>{email}>>>traffic>>>uplink|downlink
+        by_email: Dict[str, Dict[str, int]] = {}
+        for stat_item in stats_data.get("stat", []):
+            parts = stat_item.get("name", "").split(">>>")
+            if len(parts) != 4 or parts[0] != "user":
+                continue
+            user = by_email.setdefault(parts[1], {"upload": 0, "download": 0})
+            value = int(stat_item.get("value", 0) or 0)
+            if parts[3] == "uplink":
+                user["upload"] += value
+            elif parts[3] == "downlink":
+                user["download"] += value
+        return by_email
+
     async def get_user_stats(self, email: str) -> Dict[str, int]:
         """
         Получение статистики трафика для конкретного пользователя
@@ -497,16 +569,17 @@ class XrayClient:
         download = 0
 
         # Xray возвращает статистику в формате:
-        # {"stat": [{"name": "user>>>email>>>uplink", "value": 12345}, ...]}
-        if "stat" in stats:
-            for stat_item in stats["stat"]:
-                name = stat_item.get("name", "")
-                value = stat_item.get("value", 0)
-
-                if f">>>{email}>>>" in name:
-                    if "uplink" in name:
-                        upload += value
-                    elif "downlink" in name:
-                        download += value
+        # {"stat": [{"name": "user>>>email>>>traffic>>>uplink", "value": 12345}, ...]}
+        # Имя начинается с того же префикса, что и --pattern запроса, поэтому
+        # достаточно проверить начало и окончание строки
+        prefix = f"user>>>{email}>>>"
+        for stat_item in stats.get("stat", ()):
+            name = stat_item.get("name", "")
+            if not name.startswith(prefix):
+                continue
+            if name.endswith("uplink"):
+                upload += stat_item.get("value", 0)
+            elif name.endswith("downlink"):
+                download += stat_item.get("value", 0)
 
         return {"upload": upload, "download": download}
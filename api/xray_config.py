@@ -1,16 +1,47 @@
 """Управление конфигурацией Xray"""
 
+import fcntl
+import functools
 import json
 import logging
+import os
+import shutil
 import subprocess
 import tempfile
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Any, List, Optional, Set, Tuple
 from config.settings import settings
 
 logger = logging.getLogger(__name__)
 
 
+def _with_config_lock(method):
+    """
+    Выполнить метод под эксклюзивным flock на config.json.lock.
+
+    Read-modify-write config.json сериализуется между потоками и между
+    воркерами uvicorn (--workers N), иначе параллельные записи теряют клиентов.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        lock_path = self.config_file.with_suffix(".json.lock")
+        try:
+            lock_file = open(lock_path, "a")
+        except OSError as e:
+            # Нет каталога/прав — работаем без блокировки, как раньше
+            logger.debug(f"Config lock unavailable ({lock_path}): {e}")
+            return method(self, *args, **kwargs)
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return wrapper
+
+
 class XrayConfigManager:
     """Менеджер для управления конфигурацией Xray"""
 
@@ -150,14 +181,17 @@ class XrayConfigManager:
             # Создаем резервную копию
             backup_path = self.config_file.with_suffix(".json.backup")
             if self.config_file.exists():
-                import shutil
-
                 shutil.copy2(self.config_file, backup_path)
                 logger.debug(f"Backup created: {backup_path}")
 
-            # Сохраняем новую конфигурацию
-            with open(self.config_file, "w", encoding="utf-8") as f:
+            # Сохраняем новую конфигурацию атомарно: tmp-файл рядом + rename,
+            # чтобы Xray и параллельные читатели не увидели частично записанный JSON
+            tmp_path = self.config_file.with_suffix(".json.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
                 json.dump(config, f, indent=2, ensure_ascii=False)
+            if self.config_file.exists():
+                shutil.copymode(self.config_file, tmp_path)
+            os.replace(tmp_path, self.config_file)
 
             logger.info(f"✅ Xray config saved to {self.config_path}")
             return True
@@ -208,10 +242,20 @@ class XrayConfigManager:
         email: Optional[str] = None,
         *,
         use_flow: bool = True,
+        existing_ids: Optional[Set[str]] = None,
     ) -> bool:
-        """Добавить клиента в inbound. True если новый клиент добавлен."""
+        """
+        Добавить клиента в inbound. True если новый клиент добавлен.
+
+        existing_ids — множество id клиентов этого inbound для проверки за O(1)
+        при массовом добавлении; пополняется добавленным uuid.
+        """
         clients = vless_inbound["settings"].setdefault("clients", [])
-        if any(client.get("id") == uuid for client in clients):
+        if existing_ids is not None:
+            if uuid in existing_ids:
+                return False
+            existing_ids.add(uuid)
+        elif any(client.get("id") == uuid for client in clients):
             return False
         if not email:
             email = f"user_{uuid[:8]}"
@@ -222,6 +266,7 @@ class XrayConfigManager:
         vless_inbound["settings"]["clients"] = clients
         return True
 
+    @_with_config_lock
     def bulk_sync_vless_clients(
         self,
         users: List[Tuple[str, Optional[str]]],
@@ -233,7 +278,7 @@ class XrayConfigManager:
 
         users: список (uuid, email).
         """
-        result = {
+        result: dict[str, Any] = {
             "added": 0,
             "already_present": 0,
             "saved": False,
@@ -248,22 +293,40 @@ class XrayConfigManager:
                 return result
 
             common_short_id = settings.reality_common_short_id
-            if self._ensure_common_short_id_in_config(config, common_short_id):
+            short_id_added = self._ensure_common_short_id_in_config(
+                config, common_short_id
+            )
+            if short_id_added:
                 logger.info(
                     f"✅ Added common short_id '{common_short_id}' during bulk sync"
                 )
 
+            # Множества id и флаги flow считаем один раз на inbound,
+            # а не на каждого пользователя (иначе O(users × clients))
+            tags_without_flow = set(settings.vless_inbound_tags_without_flow())
+            inbound_states = [
+                (
+                    inbound,
+                    inbound.get("tag") not in tags_without_flow,
+                    {
+                        client.get("id")
+                        for client in inbound["settings"].get("clients", [])
+                    },
+                )
+                for inbound in vless_inbounds
+            ]
+
             for uuid, email in users:
                 # Добавляем клиента во все VLESS inbounds (tcp + alt + xhttp)
                 any_added = False
                 any_present = False
-                for inbound in vless_inbounds:
-                    use_flow = (
-                        inbound.get("tag")
-                        not in settings.vless_inbound_tags_without_flow()
-                    )
+                for inbound, use_flow, existing_ids in inbound_states:
                     if self._add_client_in_config(
-                        inbound, uuid, email, use_flow=use_flow
+                        inbound,
+                        uuid,
+                        email,
+                        use_flow=use_flow,
+                        existing_ids=existing_ids,
                     ):
                         any_added = True
                     else:
@@ -273,6 +336,15 @@ class XrayConfigManager:
                 elif any_present:
                     result["already_present"] += 1
 
+            if not result["added"] and not short_id_added:
+                # Конфиг уже содержит всех пользователей — без xray -test и записи
+                result["saved"] = True
+                logger.info(
+                    "✅ Bulk VLESS sync: config already up to date "
+                    f"(already_present={result['already_present']}), write skipped"
+                )
+                return result
+
             if self.save_config(config, validate=validate, test=test):
                 result["saved"] = True
                 logger.info(
@@ -287,6 +359,69 @@ class XrayConfigManager:
             result["error"] = str(e)
             return result
 
+    @_with_config_lock
+    def apply_user_mutations(
+        self,
+        mutations: List[Tuple[str, str, Optional[str]]],
+        validate: bool = True,
+        test: bool = True,
+    ) -> bool:
+        """
+        Применить пачку добавлений/удалений клиентов одной записью config.json.
+
+        mutations: список (action, uuid, email) в порядке поступления,
+        action — "add" или "remove" (email для "remove" не используется).
+
+        Returns:
+            True если конфигурация сохранена, False в противном случае
+        """
+        try:
+            config = self.load_config()
+            tags = settings.vless_inbound_tags()
+            vless_inbounds = self._get_inbounds_by_tags(config, tags)
+            if not vless_inbounds:
+                logger.error("VLESS inbounds not found in Xray config")
+                return False
+
+            self._ensure_common_short_id_in_config(
+                config, settings.reality_common_short_id
+            )
+            without_flow = settings.vless_inbound_tags_without_flow()
+
+            added = removed = 0
+            for action, uuid, email in mutations:
+                if action == "add":
+                    for inbound in vless_inbounds:
+                        if self._add_client_in_config(
+                            inbound,
+                            uuid,
+                            email,
+                            use_flow=inbound.get("tag") not in without_flow,
+                        ):
+                            added += 1
+                elif action == "remove":
+                    for inbound in vless_inbounds:
+                        inbound_settings = inbound.setdefault("settings", {})
+                        clients = inbound_settings.get("clients", [])
+                        kept = [c for c in clients if c.get("id") != uuid]
+                        removed += len(clients) - len(kept)
+                        inbound_settings["clients"] = kept
+                else:
+                    logger.error(f"Unknown config mutation: {action}")
+
+            if not self.save_config(config, validate=validate, test=test):
+                logger.error("Failed to save Xray config")
+                return False
+            logger.info(
+                f"✅ Applied {len(mutations)} user mutation(s) to Xray config in one save "
+                f"(client entries added={added}, removed={removed})"
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error applying user mutations to Xray config: {e}")
+            return False
+
+    @_with_config_lock
     def ensure_common_short_id(self, common_short_id: str) -> bool:
         """
         Убедиться, что общий short_id присутствует в конфигурации Xray
@@ -320,6 +455,7 @@ class XrayConfigManager:
             logger.error(f"Error ensuring common short_id: {e}")
             return False
 
+    @_with_config_lock
     def add_user_to_config(
         self,
         uuid: str,
@@ -385,6 +521,7 @@ class XrayConfigManager:
             logger.error(f"Error adding user to Xray config: {e}")
             return False
 
+    @_with_config_lock
     def remove_user_from_config(
         self, uuid: str, short_id: str, reload: bool = False
     ) -> bool:
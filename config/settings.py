@@ -26,6 +26,11 @@ class Settings(BaseSettings):
 
     # База данных
     database_url: str = "sqlite:///./database/veil_xray.db"
+    # Пул соединений: pool_size ≈ число одновременных запросов с открытой
+    # DB-сессией на воркер (read-эндпоинты идут через threadpool на 40 потоков)
+    db_pool_size: int = 20
+    db_max_overflow: int = 20
+    db_pool_recycle_s: int = 1800
 
     # Xray настройки
     xray_api_host: str = "127.0.0.1"
@@ -90,11 +95,27 @@ class Settings(BaseSettings):
     # Фоновая синхронизация трафика Xray → SQLite
     enable_background_traffic_sync: bool = False
     background_traffic_sync_interval_s: int = 600
+    # Не используется: проход пишет все активные ключи из одного statsquery.
+    # Оставлено, чтобы старые .env с BACKGROUND_TRAFFIC_SYNC_BATCH_SIZE загружались
     background_traffic_sync_batch_size: int = 50
 
+    # Файл-замок лидера фоновых задач: при uvicorn --workers N синхронизацию
+    # пользователей и трафика выполняет только воркер, захвативший flock
+    background_leader_lock_file: str = "./database/.background_leader.lock"
+
+    # Максимум одновременных вызовов xray CLI при синхронизации пользователей/трафика
+    xray_sync_concurrency: int = 32
+
     # Кэш статистики трафика в памяти (секунды; 1800 = 30 мин)
     traffic_cache_ttl_s: int = 3600
 
+    # Кэш строк ключей (key_id → поля Key) для read-эндпоинтов
+    key_cache_ttl_s: int = 60
+    key_cache_max_size: int = 4096
+    # Метка инвалидации кэша ключей, общая для воркеров: create/delete в одном
+    # воркере переписывают файл, остальные сбрасывают свои кэши при следующем чтении
+    key_cache_stamp_file: str = "./database/.key_cache_stamp"
+
     model_config = SettingsConfigDict(env_file=".env", case_sensitive=False)
 
     @property
@@ -90,6 +90,7 @@ def mock_xray_client(monkeypatch):
     mock_client.reset_user_stats = AsyncMock(return_value=True)
     mock_client.get_stats = AsyncMock(return_value={"stat": []})
     mock_client.get_user_stats = AsyncMock(return_value={"upload": 0, "download": 0})
+    mock_client.get_all_user_stats = AsyncMock(return_value={})
     monkeypatch.setattr("api.main.xray_client", mock_client)
     return mock_client
 
@@ -104,6 +105,25 @@ def clear_traffic_cache():
     main_module.traffic_cache.clear()
 
 
+@pytest.fixture(autouse=True)
+def clear_key_cache(monkeypatch, tmp_path):
+    """Глобальный key_cache в api.main: id ключей повторяются между тестовыми БД."""
+    import api.main as main_module
+
+    # Метка инвалидации между воркерами — во временной директории теста
+    monkeypatch.setattr(
+        settings, "key_cache_stamp_file", str(tmp_path / ".key_cache_stamp")
+    )
+    monkeypatch.setattr(main_module, "_key_cache_stamp", None)
+    main_module.key_cache.clear()
+    main_module.key_uuid_index.clear()
+    main_module.key_list_cache.clear()
+    yield
+    main_module.key_cache.clear()
+    main_module.key_uuid_index.clear()
+    main_module.key_list_cache.clear()
+
+
 @pytest.fixture(autouse=True)
 def expand_allowed_ips_for_tests(monkeypatch):
     """Starlette TestClient подставляет client host 'testclient'."""
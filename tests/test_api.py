@@ -18,6 +18,7 @@ def test_health(client):
     response = client.get("/health")
     assert response.status_code == status.HTTP_200_OK
     assert response.json()["service"] == "veil-xray-api"
+    assert response.headers["content-type"] == "application/json"
 
 
 def test_public_health_bypasses_ip_whitelist(client, monkeypatch):
@@ -224,13 +225,19 @@ def test_sync_all_traffic(client, auth_headers, mock_xray_client):
     """Тест синхронизации статистики для всех ключей"""
     from unittest.mock import AsyncMock
 
+    from api.database import xray_email
+
     # Создаем несколько ключей
+    emails = []
     for i in range(3):
-        client.post("/api/keys", json={"name": f"test_key_{i}"}, headers=auth_headers)
+        data = client.post(
+            "/api/keys", json={"name": f"test_key_{i}"}, headers=auth_headers
+        ).json()
+        emails.append(xray_email(data["key_id"], data["uuid"]))
 
-    # Мокируем get_user_stats для каждого ключа
-    mock_xray_client.get_user_stats = AsyncMock(
-        return_value={"upload": 1000, "download": 2000}
+    # Мокируем общий запрос статистики: данные для каждого ключа
+    mock_xray_client.get_all_user_stats = AsyncMock(
+        return_value={email: {"upload": 1000, "download": 2000} for email in emails}
     )
 
     # Синхронизируем статистику
@@ -241,6 +248,7 @@ def test_sync_all_traffic(client, auth_headers, mock_xray_client):
     assert "updated" in data
     assert "errors" in data
     assert data["updated"] >= 3
+    assert mock_xray_client.get_all_user_stats.await_count == 1
 
 
 def test_sync_all_traffic_unauthorized(client):
@@ -349,25 +357,18 @@ def test_sync_all_traffic_with_errors(client, auth_headers, mock_xray_client):
         )
         key_ids.append(create_response.json()["key_id"])
 
-    # Мокируем get_user_stats чтобы один из вызовов падал с ошибкой
-    call_count = 0
-
-    async def mock_get_user_stats(email):
-        nonlocal call_count
-        call_count += 1
-        if call_count == 2:  # Второй вызов падает
-            raise Exception("Xray API error")
-        return {"upload": 1000, "download": 2000}
+    # Общий запрос статистики к Xray завершается ошибкой
+    from unittest.mock import AsyncMock
 
-    mock_xray_client.get_user_stats = mock_get_user_stats
+    mock_xray_client.get_all_user_stats = AsyncMock(return_value=None)
 
     # Синхронизируем статистику
     response = client.post("/api/traffic/sync", headers=auth_headers)
     assert response.status_code == status.HTTP_200_OK
     data = response.json()
     assert data["success"] is True
-    assert data["errors"] >= 1  # Должна быть хотя бы одна ошибка
-    assert data["updated"] >= 1  # Но хотя бы один должен обновиться
+    assert data["errors"] == 3  # Ни один ключ не получил статистику
+    assert data["updated"] == 0  # Сохранённые значения не затираются нулями
 
 
 def test_reset_traffic(client, auth_headers, mock_xray_client):
@@ -414,3 +415,1004 @@ def test_reset_traffic_unauthorized(client):
     """Тест обнуления трафика без авторизации"""
     response = client.post("/api/keys/1/traffic/reset")
     assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+def test_get_key_served_from_key_cache(client, auth_headers):
+    """Повторное чтение ключа берётся из key_cache; удаление его инвалидирует."""
+    import api.main as main_module
+
+    create_response = client.post(
+        "/api/keys", json={"name": "cached"}, headers=auth_headers
+    )
+    key_id = create_response.json()["key_id"]
+
+    assert client.get(f"/api/keys/{key_id}", headers=auth_headers).status_code == 200
+    assert key_id in main_module.key_cache
+
+    assert client.delete(f"/api/keys/{key_id}", headers=auth_headers).status_code == 200
+    assert key_id not in main_module.key_cache
+    response = client.get(f"/api/keys/{key_id}", headers=auth_headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_create_key_retries_on_uuid_collision(client, auth_headers, monkeypatch):
+    """Коллизия UUID ловится на INSERT (IntegrityError) и UUID перегенерируется."""
+    duplicate = "00000000-0000-4000-8000-000000000001"
+    uuids = iter([duplicate, duplicate, "00000000-0000-4000-8000-000000000002"])
+    monkeypatch.setattr("api.main.generate_uuid", lambda: next(uuids))
+
+    first = client.post("/api/keys", json={"name": "a"}, headers=auth_headers)
+    assert first.status_code == status.HTTP_200_OK
+    assert first.json()["uuid"] == duplicate
+
+    second = client.post("/api/keys", json={"name": "b"}, headers=auth_headers)
+    assert second.status_code == status.HTTP_200_OK
+    assert second.json()["uuid"] == "00000000-0000-4000-8000-000000000002"
+
+
+def test_list_keys_returns_key_fields(client, auth_headers):
+    """list_keys собирает ответ из Core-строк: все поля KeyResponse на месте."""
+    created = client.post("/api/keys", json={"name": "row"}, headers=auth_headers)
+    expected = created.json()
+
+    response = client.get("/api/keys", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert data["total"] == 1
+    assert data["keys"] == [expected]
+
+
+def test_key_query_raises_on_lazy_traffic_stats(client, auth_headers, test_db):
+    """Ленивая подгрузка traffic_stats запрещена (lazy="raise", защита от N+1)."""
+    from sqlalchemy.exc import InvalidRequestError
+    from sqlalchemy.orm import Session
+
+    from api.database import Key
+
+    client.post("/api/keys", json={"name": "n1"}, headers=auth_headers)
+
+    with Session(test_db) as db:
+        key = db.query(Key).filter(Key.name == "n1").first()
+        assert key is not None
+        with pytest.raises(InvalidRequestError):
+            _ = key.traffic_stats
+
+
+def test_create_key_stores_xray_email(client, auth_headers, test_db):
+    """Email для Xray сохраняется в keys.email при создании ключа."""
+    from sqlalchemy.orm import Session
+
+    from api.database import Key
+
+    data = client.post("/api/keys", json={"name": "e"}, headers=auth_headers).json()
+
+    with Session(test_db) as db:
+        key = db.get(Key, data["key_id"])
+        assert key.email == f"user_{data['key_id']}_{data['uuid'][:8]}"
+
+
+def test_list_keys_with_traffic(client, auth_headers, mock_xray_client):
+    """Список ключей со статистикой трафика из БД."""
+    from unittest.mock import AsyncMock
+
+    key_ids = [
+        client.post("/api/keys", json={"name": f"k{i}"}, headers=auth_headers).json()[
+            "key_id"
+        ]
+        for i in range(2)
+    ]
+    mock_xray_client.get_user_stats = AsyncMock(
+        return_value={"upload": 100, "download": 200}
+    )
+    client.get(f"/api/keys/{key_ids[0]}/traffic", headers=auth_headers)
+
+    response = client.get("/api/keys-with-traffic", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert data["total"] == 2
+    by_id = {k["key_id"]: k for k in data["keys"]}
+    assert by_id[key_ids[0]]["total"] == 300
+    assert by_id[key_ids[1]]["upload"] == 0
+    assert by_id[key_ids[1]]["short_id"] == settings.reality_common_short_id
+
+
+def test_list_keys_with_traffic_unauthorized(client):
+    """Список ключей с трафиком без авторизации"""
+    response = client.get("/api/keys-with-traffic")
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+def test_invalid_token_rejected(client):
+    """Неверный токен (в т.ч. не-ASCII) — 401, а не ошибка сервера."""
+    for token in ("wrong-token", "неверный-токен"):
+        response = client.get(
+            "/api/keys", headers={"Authorization": f"Bearer {token}".encode("utf-8")}
+        )
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_get_traffic_upserts_single_row(
+    client, auth_headers, mock_xray_client, test_db
+):
+    """Повторный запрос /traffic обновляет ту же строку TrafficStats."""
+    from unittest.mock import AsyncMock
+
+    from sqlalchemy.orm import Session
+
+    import api.main as main_module
+    from api.database import TrafficStats
+
+    key_id = client.post(
+        "/api/keys", json={"name": "upsert"}, headers=auth_headers
+    ).json()["key_id"]
+
+    for upload in (100, 200):
+        main_module.traffic_cache.clear()
+        mock_xray_client.get_user_stats = AsyncMock(
+            return_value={"upload": upload, "download": 1}
+        )
+        assert (
+            client.get(f"/api/keys/{key_id}/traffic", headers=auth_headers).status_code
+            == status.HTTP_200_OK
+        )
+
+    with Session(test_db) as db:
+        rows = db.query(TrafficStats).filter(TrafficStats.key_id == key_id).all()
+    assert len(rows) == 1
+    assert rows[0].upload == 200
+
+
+def test_get_vless_link_uses_per_settings_template(client, auth_headers, monkeypatch):
+    """Ссылка из шаблона содержит UUID ключа и пересобирается при смене pbk."""
+    import api.main as main_module
+
+    monkeypatch.setattr(settings, "reality_public_key", "pbk_one")
+    data = client.post("/api/keys", json={"name": "tpl"}, headers=auth_headers).json()
+
+    first = client.get(f"/api/keys/{data['key_id']}/link", headers=auth_headers)
+    assert first.status_code == status.HTTP_200_OK
+    link = first.json()["vless_link"]
+    assert link.startswith(f"vless://{data['uuid']}@")
+    assert "pbk=pbk_one" in link
+
+    monkeypatch.setattr(settings, "reality_public_key", "pbk_two")
+    second = client.get(f"/api/keys/{data['uuid']}/link", headers=auth_headers)
+    assert "pbk=pbk_two" in second.json()["vless_link"]
+    assert len(main_module._vless_link_templates) >= 2
+
+
+def test_link_and_config_endpoints_share_primary_link(
+    client, auth_headers, monkeypatch
+):
+    """/link, /config и /uuid/{uuid}/config отдают одну и ту же основную ссылку."""
+    monkeypatch.setattr(settings, "reality_public_key", "pbk_shared")
+    data = client.post("/api/keys", json={"name": "same"}, headers=auth_headers).json()
+
+    paths = [
+        f"/api/keys/{data['key_id']}/link",
+        f"/api/keys/{data['key_id']}/config",
+        f"/api/keys/uuid/{data['uuid']}/config",
+    ]
+    bodies = [client.get(path, headers=auth_headers).json() for path in paths]
+    assert all(body == bodies[0] for body in bodies)
+    assert bodies[0]["key_id"] == data["key_id"]
+
+    monkeypatch.setattr(settings, "reality_public_key", None)
+    missing = client.get(f"/api/keys/uuid/{data['uuid']}/config", headers=auth_headers)
+    assert missing.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def test_delete_key_cascades_traffic_stats(client, auth_headers, test_db):
+    """Удаление ключа удаляет его TrafficStats при lazy="raise" на связи."""
+    from sqlalchemy.orm import Session
+
+    from api.database import TrafficStats
+
+    key_id = client.post(
+        "/api/keys", json={"name": "cascade"}, headers=auth_headers
+    ).json()["key_id"]
+    assert client.delete(f"/api/keys/{key_id}", headers=auth_headers).status_code == 200
+
+    with Session(test_db) as db:
+        assert db.query(TrafficStats).filter(TrafficStats.key_id == key_id).count() == 0
+
+
+async def test_collect_traffic_stats_uses_single_bulk_call(mock_xray_client):
+    """Статистика всех ключей берётся одним get_all_user_stats."""
+    from unittest.mock import AsyncMock
+
+    import api.main as main_module
+
+    mock_xray_client.get_all_user_stats = AsyncMock(
+        return_value={"user_1": {"upload": 1, "download": 2}}
+    )
+    keys = [(1, "user_1"), (2, "user_2")]
+
+    stats, errors = await main_module._collect_traffic_stats(keys, 123)
+
+    assert mock_xray_client.get_all_user_stats.await_count == 1
+    assert mock_xray_client.get_user_stats.await_count == 0
+    assert errors == 0
+    assert stats == {1: (1, 2, 123), 2: (0, 0, 123)}
+
+
+def test_store_traffic_stats_updates_and_inserts(client, auth_headers, test_db):
+    """_store_traffic_stats обновляет существующие строки и вставляет недостающие."""
+    from sqlalchemy.orm import Session
+
+    import api.main as main_module
+    from api.database import TrafficStats
+
+    key_id = client.post(
+        "/api/keys", json={"name": "bulk"}, headers=auth_headers
+    ).json()["key_id"]
+
+    with Session(test_db) as db:
+        db.query(TrafficStats).filter(TrafficStats.key_id == key_id).delete()
+        db.commit()
+        assert main_module._store_traffic_stats(db, {key_id: (1, 2, 10)}) == 1
+        assert main_module._store_traffic_stats(db, {key_id: (3, 4, 20)}) == 1
+        rows = db.query(TrafficStats).filter(TrafficStats.key_id == key_id).all()
+    assert [(r.upload, r.download, r.updated_at) for r in rows] == [(3, 4, 20)]
+
+
+def test_traffic_upsert_statement():
+    """Статистика пишется одним INSERT ... ON CONFLICT (key_id) на SQLite и PostgreSQL."""
+    from sqlalchemy.dialects import postgresql, sqlite
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+    import api.main as main_module
+
+    rows = [
+        {"key_id": 1, "upload": 10, "download": 20, "updated_at": 30},
+        {"key_id": 2, "upload": 1, "download": 2, "updated_at": 3},
+    ]
+    for stmt, dialect in (
+        (main_module._traffic_upsert(rows, pg_insert), postgresql.dialect()),
+        (main_module._traffic_upsert(rows), sqlite.dialect()),
+    ):
+        sql = str(stmt.compile(dialect=dialect))
+        assert sql.count("INSERT INTO traffic_stats") == 1
+        assert "ON CONFLICT (key_id) DO UPDATE" in sql
+        assert "upload = excluded.upload" in sql
+
+
+def test_store_traffic_stats_chunks_statements(
+    client, auth_headers, test_db, monkeypatch
+):
+    """Большая пачка делится на несколько upsert-запросов, commit один."""
+    from sqlalchemy.orm import Session
+
+    import api.main as main_module
+
+    key_ids = [
+        client.post("/api/keys", json={"name": f"c{i}"}, headers=auth_headers).json()[
+            "key_id"
+        ]
+        for i in range(3)
+    ]
+    monkeypatch.setattr(main_module, "_TRAFFIC_UPSERT_CHUNK", 2)
+    with Session(test_db) as db:
+        executed = []
+        original = db.execute
+        monkeypatch.setattr(
+            db,
+            "execute",
+            lambda stmt, *a, **kw: executed.append(stmt) or original(stmt, *a, **kw),
+        )
+        stored = main_module._store_traffic_stats(db, {k: (5, 6, 7) for k in key_ids})
+    assert stored == 3
+    assert len(executed) == 2
+
+
+def test_list_keys_cache_invalidated_on_write(client, auth_headers):
+    """GET /api/keys отдаётся из key_list_cache и сбрасывается при create/delete."""
+    import api.main as main_module
+
+    assert client.get("/api/keys", headers=auth_headers).json()["total"] == 0
+    assert "all" in main_module.key_list_cache
+
+    key_id = client.post(
+        "/api/keys", json={"name": "listed"}, headers=auth_headers
+    ).json()["key_id"]
+    assert "all" not in main_module.key_list_cache
+    assert client.get("/api/keys", headers=auth_headers).json()["total"] == 1
+
+    client.delete(f"/api/keys/{key_id}", headers=auth_headers)
+    assert client.get("/api/keys", headers=auth_headers).json()["total"] == 0
+
+
+def test_create_key_does_not_trigger_traffic_statsquery(
+    client, auth_headers, mock_xray_client
+):
+    """Новый ключ получает нулевую TrafficStats сразу, без statsquery по всем."""
+    key_id = client.post(
+        "/api/keys", json={"name": "fresh"}, headers=auth_headers
+    ).json()["key_id"]
+
+    mock_xray_client.get_all_user_stats.assert_not_awaited()
+    response = client.get(f"/api/keys/{key_id}/traffic", headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json()["total"] == 0
+
+
+def test_create_key_writes_traffic_stats_in_same_commit(
+    client, auth_headers, test_db, monkeypatch
+):
+    """Key и его начальная TrafficStats фиксируются одним commit."""
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    from api.database import TrafficStats
+
+    commits = []
+
+    def listener(conn):
+        commits.append(conn)
+
+    event.listen(test_db, "commit", listener)
+    try:
+        key_id = client.post(
+            "/api/keys", json={"name": "atomic"}, headers=auth_headers
+        ).json()["key_id"]
+    finally:
+        event.remove(test_db, "commit", listener)
+
+    assert len(commits) == 1
+    with Session(test_db) as db:
+        stats = db.query(TrafficStats).filter(TrafficStats.key_id == key_id).one()
+    assert (stats.upload, stats.download) == (0, 0)
+
+
+async def test_sync_users_writes_config_off_event_loop(
+    client, auth_headers, mock_xray_client, monkeypatch
+):
+    """bulk_sync_vless_clients выполняется в потоке, не в event loop."""
+    import threading
+
+    import api.main as main_module
+
+    client.post("/api/keys", json={"name": "startup"}, headers=auth_headers)
+    mock_xray_client.check_health.return_value = True
+    mock_xray_client.add_user.return_value = True
+    threads = []
+
+    def fake_bulk(users):
+        threads.append(threading.get_ident())
+        return {"saved": True, "added": len(users), "already_present": 0}
+
+    monkeypatch.setattr(
+        main_module.xray_config_manager, "bulk_sync_vless_clients", fake_bulk
+    )
+    result = await main_module.sync_users_with_xray()
+
+    assert threads and threads[0] != threading.get_ident()
+    assert result["synced_config_count"] == 1
+    assert result["synced_api_count"] == 1
+
+
+def test_reset_traffic_returns_previous_values(client, auth_headers, test_db):
+    """reset возвращает значения из traffic_stats и обнуляет строку."""
+    from sqlalchemy import update
+    from sqlalchemy.orm import Session
+
+    from api.database import TrafficStats
+
+    key_id = client.post(
+        "/api/keys", json={"name": "reset"}, headers=auth_headers
+    ).json()["key_id"]
+    with Session(test_db) as db:
+        db.execute(
+            update(TrafficStats)
+            .where(TrafficStats.key_id == key_id)
+            .values(upload=100, download=200)
+        )
+        db.commit()
+
+    data = client.post(f"/api/keys/{key_id}/traffic/reset", headers=auth_headers).json()
+    assert (data["previous_upload"], data["previous_download"]) == (100, 200)
+    with Session(test_db) as db:
+        stats = db.query(TrafficStats).filter(TrafficStats.key_id == key_id).one()
+    assert (stats.upload, stats.download) == (0, 0)
+
+
+def test_async_endpoints_query_db_off_event_loop(client, auth_headers, monkeypatch):
+    """reset_traffic и промах key_cache в get_traffic читают БД вне event loop."""
+    import threading
+
+    import api.main as main_module
+
+    key_id = client.post(
+        "/api/keys", json={"name": "off-loop"}, headers=auth_headers
+    ).json()["key_id"]
+    main_module.key_cache.clear()
+    threads = {}
+
+    def tracking(name, func):
+        def wrapper(*args):
+            threads[name] = threading.get_ident()
+            return func(*args)
+
+        return wrapper
+
+    # TestClient поднимает event loop в новом потоке на каждый запрос,
+    # поэтому поток loop сравниваем в пределах одного запроса
+    async def fake_stats(email):
+        threads["stats_loop"] = threading.get_ident()
+        return {"upload": 1, "download": 2}
+
+    async def fake_reset(email):
+        threads["reset_loop"] = threading.get_ident()
+        return True
+
+    monkeypatch.setattr(
+        main_module, "_load_key_row", tracking("load", main_module._load_key_row)
+    )
+    monkeypatch.setattr(
+        main_module,
+        "_reset_traffic_row",
+        tracking("reset", main_module._reset_traffic_row),
+    )
+    monkeypatch.setattr(main_module.xray_client, "get_user_stats", fake_stats)
+    monkeypatch.setattr(main_module.xray_client, "reset_user_stats", fake_reset)
+
+    assert (
+        client.get(f"/api/keys/{key_id}/traffic", headers=auth_headers).status_code
+        == 200
+    )
+    reset = client.post(f"/api/keys/{key_id}/traffic/reset", headers=auth_headers)
+    assert reset.status_code == status.HTTP_200_OK
+    assert threads["load"] != threads["stats_loop"]
+    assert threads["reset"] != threads["reset_loop"]
+
+
+def test_delete_key_fallback_removes_config_in_thread(
+    client, auth_headers, monkeypatch
+):
+    """Fallback remove_user_from_config при таймауте очереди идёт через to_thread."""
+    import asyncio
+    import threading
+    from unittest.mock import AsyncMock
+
+    import api.main as main_module
+
+    key_id = client.post(
+        "/api/keys", json={"name": "fallback"}, headers=auth_headers
+    ).json()["key_id"]
+    monkeypatch.setattr(
+        main_module.config_task_queue,
+        "execute_task_and_wait",
+        AsyncMock(side_effect=asyncio.TimeoutError),
+    )
+    loop_thread = {}
+    calls = []
+
+    def fake_remove(uuid, short_id):
+        calls.append(threading.get_ident())
+        return True
+
+    async def fake_remove_user(email):
+        loop_thread["id"] = threading.get_ident()
+        return True
+
+    monkeypatch.setattr(
+        main_module.xray_config_manager, "remove_user_from_config", fake_remove
+    )
+    monkeypatch.setattr(main_module.xray_client, "remove_user", fake_remove_user)
+
+    response = client.delete(f"/api/keys/{key_id}", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert calls and calls[0] != loop_thread["id"]
+
+
+async def test_sync_users_add_user_bounded_concurrency(
+    client, auth_headers, mock_xray_client, monkeypatch
+):
+    """add_user вызывается параллельно, но не больше XRAY_SYNC_CONCURRENCY сразу."""
+    import asyncio
+
+    import api.main as main_module
+
+    for i in range(6):
+        client.post("/api/keys", json={"name": f"k{i}"}, headers=auth_headers)
+    monkeypatch.setattr(main_module, "XRAY_SYNC_CONCURRENCY", 2)
+    monkeypatch.setattr(
+        main_module.xray_config_manager,
+        "bulk_sync_vless_clients",
+        lambda users: {"saved": True, "added": 0, "already_present": len(users)},
+    )
+    mock_xray_client.check_health.return_value = True
+    in_flight = 0
+    peak = 0
+
+    async def slow_add_user(uuid, email, flow):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return True
+
+    mock_xray_client.add_user.side_effect = slow_add_user
+    result = await main_module.sync_users_with_xray()
+
+    assert peak == 2
+    assert result["synced_api_count"] == 6
+
+
+def test_setup_logging_uses_queue_listener():
+    """Root logger пишет в очередь; stop_logging возвращает handlers на root."""
+    import logging
+    import logging.handlers
+
+    import api.main as main_module
+
+    root = logging.getLogger()
+    main_module.setup_logging()
+    try:
+        assert [type(h) for h in root.handlers] == [logging.handlers.QueueHandler]
+        assert main_module._log_listener is not None
+    finally:
+        main_module.stop_logging()
+
+    assert main_module._log_listener is None
+    assert not any(isinstance(h, logging.handlers.QueueHandler) for h in root.handlers)
+    assert any(isinstance(h, logging.StreamHandler) for h in root.handlers)
+    main_module.setup_logging()
+
+
+def test_logging_middleware_logs_path_with_query(client, auth_headers, caplog):
+    """Строка запроса в логе: METHOD path?query - Status - Time."""
+    import logging
+
+    with caplog.at_level(logging.INFO, logger="api.main"):
+        client.get("/api/keys?limit=5", headers=auth_headers)
+
+    messages = [r.getMessage() for r in caplog.records if r.name == "api.main"]
+    assert any(
+        m.startswith("GET /api/keys?limit=5 - Status: 200 - Time: ") for m in messages
+    )
+
+
+async def test_background_traffic_sync_cancels_hung_run(
+    client, auth_headers, mock_xray_client, monkeypatch
+):
+    """Проход дольше интервала прерывается, следующий проход выполняется."""
+    import asyncio
+    from unittest.mock import AsyncMock
+
+    import api.main as main_module
+
+    client.post("/api/keys", json={"name": "hung"}, headers=auth_headers)
+    monkeypatch.setattr(main_module, "ENABLE_BACKGROUND_TRAFFIC_SYNC", True)
+    monkeypatch.setattr(main_module, "BACKGROUND_TRAFFIC_SYNC_INTERVAL_S", 0.05)
+    calls = 0
+
+    async def stats():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(3600)
+        return {}
+
+    mock_xray_client.get_all_user_stats = AsyncMock(side_effect=stats)
+
+    task = asyncio.create_task(main_module.sync_all_traffic_stats())
+    try:
+        for _ in range(100):
+            if calls >= 2:
+                break
+            await asyncio.sleep(0.02)
+        assert calls >= 2
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    assert not main_module._traffic_sync_lock.locked()
+
+
+def test_background_leader_lock_held_by_one_worker(monkeypatch, tmp_path):
+    """Только один процесс/воркер получает замок лидера фоновых задач."""
+    import fcntl
+    import os
+
+    import api.main as main_module
+
+    lock_file = tmp_path / "leader.lock"
+    monkeypatch.setattr(settings, "background_leader_lock_file", str(lock_file))
+    monkeypatch.setattr(main_module, "_background_leader_fd", None)
+
+    assert main_module._acquire_background_leader() is True
+    other = os.open(lock_file, os.O_RDWR)
+    try:
+        # Другой воркер (отдельный open) не может взять замок
+        with pytest.raises(OSError):
+            fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        main_module._release_background_leader()
+        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    finally:
+        os.close(other)
+    assert main_module._background_leader_fd is None
+
+
+async def test_background_traffic_sync_stores_all_active_keys(
+    client, auth_headers, mock_xray_client, test_db, monkeypatch
+):
+    """Один проход записывает счётчики всех активных ключей из одного statsquery."""
+    from unittest.mock import AsyncMock
+
+    from sqlalchemy import select
+
+    import api.main as main_module
+    from api.database import TrafficStats
+
+    created = [
+        client.post("/api/keys", json={"name": f"b{i}"}, headers=auth_headers).json()
+        for i in range(5)
+    ]
+    with test_db.connect() as conn:
+        emails = {
+            row.id: row.email
+            for row in conn.execute(select(main_module.Key.id, main_module.Key.email))
+        }
+    mock_xray_client.get_all_user_stats = AsyncMock(
+        return_value={
+            emails[c["key_id"]]: {"upload": c["key_id"], "download": 1} for c in created
+        }
+    )
+
+    # Несколько многострочных upsert за проход
+    monkeypatch.setattr(main_module, "_TRAFFIC_UPSERT_CHUNK", 2)
+
+    await main_module._sync_traffic_once()
+
+    mock_xray_client.get_all_user_stats.assert_awaited_once()
+    with test_db.connect() as conn:
+        uploads = dict(
+            conn.execute(select(TrafficStats.key_id, TrafficStats.upload)).all()
+        )
+    assert uploads == {c["key_id"]: c["key_id"] for c in created}
+
+
+def test_delete_key_by_uuid_alias(client, auth_headers, mock_xray_client):
+    """DELETE /api/keys/uuid/{uuid} использует общий путь удаления."""
+    created = client.post(
+        "/api/keys", json={"name": "alias"}, headers=auth_headers
+    ).json()
+
+    response = client.delete(f"/api/keys/uuid/{created['uuid']}", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["message"] == f"Key {created['key_id']} deleted successfully"
+    mock_xray_client.remove_user.assert_awaited()
+
+    missing = client.delete(f"/api/keys/uuid/{created['uuid']}", headers=auth_headers)
+    assert missing.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_delete_key_commits_before_config_cleanup(
+    client, auth_headers, test_db, monkeypatch
+):
+    """Строка ключа удалена из БД до очистки config.json (та идёт в фоне)."""
+    from sqlalchemy import text
+
+    import api.main as main_module
+
+    created = client.post(
+        "/api/keys", json={"name": "db-first"}, headers=auth_headers
+    ).json()
+    seen = []
+
+    async def fake_remove(key_id, uuid, email):
+        with test_db.connect() as conn:
+            seen.append(
+                conn.execute(
+                    text("SELECT COUNT(*) FROM keys WHERE id = :id"), {"id": key_id}
+                ).scalar()
+            )
+        return True
+
+    monkeypatch.setattr(main_module, "_remove_user_from_config_file", fake_remove)
+
+    response = client.delete(f"/api/keys/{created['key_id']}", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert seen == [0]
+
+
+def test_delete_key_retries_failed_xray_api_removal(
+    client, auth_headers, mock_xray_client, monkeypatch, caplog
+):
+    """Неудачный remove_user в запросе логируется и повторяется в фоне."""
+    import logging
+    from unittest.mock import AsyncMock
+
+    import api.main as main_module
+
+    created = client.post(
+        "/api/keys", json={"name": "xray-down"}, headers=auth_headers
+    ).json()
+    mock_xray_client.remove_user = AsyncMock(side_effect=[False, True])
+
+    async def fake_remove(key_id, uuid, email):
+        return True
+
+    monkeypatch.setattr(main_module, "_remove_user_from_config_file", fake_remove)
+
+    with caplog.at_level(logging.WARNING):
+        response = client.delete(f"/api/keys/{created['key_id']}", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert mock_xray_client.remove_user.await_count == 2
+    assert "Xray API did not remove the user" in caplog.text
+
+
+def test_force_https_middleware_redirect():
+    """HTTP за reverse proxy → 301 на https://Host/path?query, HTTPS проходит."""
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from api.main import ForceHTTPSMiddleware
+
+    app = FastAPI()
+    app.add_middleware(ForceHTTPSMiddleware)
+
+    @app.get("/ping")
+    def ping():
+        return {"ok": True}
+
+    with TestClient(app) as tc:
+        redirect = tc.get(
+            "/ping?a=1",
+            headers={"X-Forwarded-Proto": "http", "Host": "api.example"},
+            follow_redirects=False,
+        )
+        assert redirect.status_code == 301
+        assert redirect.headers["location"] == "https://api.example/ping?a=1"
+
+        passed = tc.get("/ping", headers={"X-Forwarded-Proto": "https"})
+        assert passed.json() == {"ok": True}
+
+
+def test_get_key_links_from_templates(client, auth_headers, monkeypatch):
+    """Профили /links собираются из шаблонов с UUID ключа; смена pbk их пересобирает."""
+    import api.main as main_module
+
+    monkeypatch.setattr(settings, "reality_public_key", "pbk_links")
+    created = client.post(
+        "/api/keys", json={"name": "links"}, headers=auth_headers
+    ).json()
+
+    response = client.get(f"/api/keys/{created['key_id']}/links", headers=auth_headers)
+    assert response.status_code == status.HTTP_200_OK
+    links = {item["profile"]: item["link"] for item in response.json()["links"]}
+    assert links["vless_tcp_443"].startswith(f"vless://{created['uuid']}@")
+    assert links["trojan_tcp"].startswith(f"trojan://{created['uuid']}@")
+    assert all("pbk=pbk_links" in link for link in links.values())
+    assert main_module._UUID_PLACEHOLDER not in "".join(links.values())
+
+    monkeypatch.setattr(settings, "reality_public_key", "pbk_links_2")
+    again = client.get(f"/api/keys/{created['uuid']}/links", headers=auth_headers)
+    assert all("pbk=pbk_links_2" in item["link"] for item in again.json()["links"])
+
+
+def test_get_bot_bundle_shape(client, auth_headers, monkeypatch):
+    """bot-bundle отдаётся напрямую, но с полями BotBundleResponse."""
+    import base64
+    import json
+
+    from api.models import BotBundleResponse
+    from api.utils import build_auto_subscription_links
+
+    monkeypatch.setattr(settings, "reality_public_key", "pbk_bundle")
+    created = client.post(
+        "/api/keys", json={"name": "bundle"}, headers=auth_headers
+    ).json()
+
+    response = client.get(
+        f"/api/keys/{created['uuid']}/bot-bundle", headers=auth_headers
+    )
+    assert response.status_code == status.HTTP_200_OK
+    body = response.json()
+    assert set(body) == set(BotBundleResponse.model_fields)
+    assert body["key_id"] == created["key_id"]
+    assert body["vless_happ"].startswith(f"vless://{created['uuid']}@")
+    # Ссылка из шаблона совпадает с построенной напрямую
+    assert (
+        body["vless_happ"]
+        == build_auto_subscription_links(uuid=created["uuid"], public_key="pbk_bundle")[
+            0
+        ]
+    )
+    decoded = json.loads(base64.b64decode(body["subscription_singbox_b64"]))
+    assert decoded == body["singbox"]
+
+
+def test_get_key_by_uuid_served_from_key_cache(client, auth_headers, test_db):
+    """Поиск по UUID после создания не обращается к БД; удаление чистит индекс."""
+    from sqlalchemy import event
+
+    import api.main as main_module
+
+    created = client.post(
+        "/api/keys", json={"name": "by-uuid"}, headers=auth_headers
+    ).json()
+    assert main_module.key_uuid_index[created["uuid"]] == created["key_id"]
+
+    statements = []
+
+    def listener(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(test_db, "before_cursor_execute", listener)
+    try:
+        response = client.get(f"/api/keys/uuid/{created['uuid']}", headers=auth_headers)
+    finally:
+        event.remove(test_db, "before_cursor_execute", listener)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()["key_id"] == created["key_id"]
+    assert not [s for s in statements if "FROM keys" in s]
+
+    client.delete(f"/api/keys/{created['uuid']}", headers=auth_headers)
+    assert created["uuid"] not in main_module.key_uuid_index
+    missing = client.get(f"/api/keys/uuid/{created['uuid']}", headers=auth_headers)
+    assert missing.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_key_cache_eviction_bounded_under_threads(monkeypatch):
+    """Параллельное заполнение key_cache не превышает key_cache_max_size."""
+    import threading
+
+    import api.main as main_module
+
+    monkeypatch.setattr(settings, "key_cache_max_size", 8)
+
+    def fill(offset):
+        for i in range(300):
+            key_id = offset * 1000 + i
+            main_module._cache_key_row(
+                main_module.KeyRow(key_id, f"uuid-{key_id}", "sid", None, 0, 1, "e"),
+                0.0,
+            )
+
+    threads = [threading.Thread(target=fill, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(main_module.key_cache) <= 8
+    assert main_module.key_uuid_index == {
+        row.uuid: key_id for key_id, (row, _) in main_module.key_cache.items()
+    }
+
+
+def test_list_keys_not_cached_when_invalidated_during_select(
+    client, auth_headers, monkeypatch
+):
+    """Инвалидация между SELECT и записью в кэш не оставляет устаревший список."""
+    import orjson
+
+    import api.main as main_module
+
+    client.post("/api/keys", json={"name": "first"}, headers=auth_headers)
+
+    class RacingOrjson:
+        @staticmethod
+        def dumps(obj):
+            # Параллельный create/delete успел закоммитить и сбросить кэш
+            main_module.invalidate_key_cache(0)
+            return orjson.dumps(obj)
+
+    monkeypatch.setattr(main_module, "orjson", RacingOrjson)
+    assert client.get("/api/keys", headers=auth_headers).json()["total"] == 1
+    assert "all" not in main_module.key_list_cache
+
+    monkeypatch.setattr(main_module, "orjson", orjson)
+    client.get("/api/keys", headers=auth_headers)
+    assert "all" in main_module.key_list_cache
+
+
+def test_key_row_not_cached_when_deleted_during_select(client, auth_headers, test_db):
+    """SELECT, завершившийся до удаления ключа, не кладёт строку в key_cache."""
+    from sqlalchemy import event
+
+    import api.main as main_module
+
+    created = client.post(
+        "/api/keys", json={"name": "race"}, headers=auth_headers
+    ).json()
+    key_id = created["key_id"]
+    main_module.invalidate_key_cache(key_id)
+
+    def listener(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            # Удаление закоммичено между SELECT и _cache_key_row
+            main_module.invalidate_key_cache(key_id)
+
+    event.listen(test_db, "after_cursor_execute", listener)
+    try:
+        assert (
+            client.get(f"/api/keys/{key_id}", headers=auth_headers).status_code == 200
+        )
+        assert (
+            client.get(f"/api/keys/{created['uuid']}", headers=auth_headers).status_code
+            == 200
+        )
+    finally:
+        event.remove(test_db, "after_cursor_execute", listener)
+
+    assert key_id not in main_module.key_cache
+    assert created["uuid"] not in main_module.key_uuid_index
+
+
+def test_key_cache_invalidated_by_other_worker(client, auth_headers, test_db):
+    """Удаление в другом воркере (новая метка в файле) сбрасывает кэш этого процесса."""
+    from pathlib import Path
+
+    from sqlalchemy import delete
+
+    import api.main as main_module
+    from api.database import Key, TrafficStats
+
+    created = client.post(
+        "/api/keys", json={"name": "shared"}, headers=auth_headers
+    ).json()
+    key_id = created["key_id"]
+    client.get("/api/keys", headers=auth_headers)
+    assert key_id in main_module.key_cache
+    assert "all" in main_module.key_list_cache
+
+    # «Другой воркер»: удаляет строку и публикует метку, не трогая кэши этого процесса
+    with test_db.begin() as conn:
+        conn.execute(delete(TrafficStats).where(TrafficStats.key_id == key_id))
+        conn.execute(delete(Key).where(Key.id == key_id))
+    Path(settings.key_cache_stamp_file).write_bytes(b"other-worker-stamp")
+    assert key_id in main_module.key_cache
+
+    assert client.get(f"/api/keys/{key_id}", headers=auth_headers).status_code == 404
+    assert (
+        client.get(
+            f"/api/keys/{created['uuid']}/config", headers=auth_headers
+        ).status_code
+        == 404
+    )
+    assert client.get("/api/keys", headers=auth_headers).json()["total"] == 0
+
+
+def test_traffic_cache_invalidated_by_other_worker_reset(
+    client, auth_headers, mock_xray_client
+):
+    """/reset публикует метку; по чужой метке воркер сбрасывает traffic_cache."""
+    from pathlib import Path
+    from unittest.mock import AsyncMock
+
+    import api.main as main_module
+
+    key_id = client.post(
+        "/api/keys", json={"name": "traffic"}, headers=auth_headers
+    ).json()["key_id"]
+    mock_xray_client.get_user_stats = AsyncMock(
+        return_value={"upload": 10, "download": 20}
+    )
+    assert (
+        client.get(f"/api/keys/{key_id}/traffic", headers=auth_headers).json()["total"]
+        == 30
+    )
+    assert key_id in main_module.traffic_cache
+
+    stamp_path = Path(settings.key_cache_stamp_file)
+    stamp_before = stamp_path.read_bytes()
+    client.post(f"/api/keys/{key_id}/traffic/reset", headers=auth_headers)
+    assert stamp_path.read_bytes() != stamp_before
+
+    # «Другой воркер» обнулил счётчики и сменил метку
+    client.get(f"/api/keys/{key_id}/traffic", headers=auth_headers)
+    assert key_id in main_module.traffic_cache
+    mock_xray_client.get_user_stats = AsyncMock(
+        return_value={"upload": 0, "download": 0}
+    )
+    stamp_path.write_bytes(b"other-worker-reset")
+
+    response = client.get(f"/api/keys/{key_id}/traffic", headers=auth_headers)
+    assert response.json()["total"] == 0
+    mock_xray_client.get_user_stats.assert_awaited_once()
@@ -136,7 +136,20 @@ def test_key_traffic_stats_relationship():
         db.add(traffic_stat)
         db.commit()
 
-        # Проверяем связь
+        # Проверяем связь (traffic_stats загружается только явной опцией)
+        from sqlalchemy.orm import selectinload
+        from sqlalchemy.exc import InvalidRequestError
+
+        with pytest.raises(InvalidRequestError):
+            _ = key.traffic_stats
+
+        key = (
+            db.query(Key)
+            .options(selectinload(Key.traffic_stats))
+            .populate_existing()
+            .filter(Key.id == key.id)
+            .one()
+        )
         assert len(key.traffic_stats) == 1
         assert traffic_stat.key.id == key.id
 
@@ -145,3 +158,128 @@ def test_key_traffic_stats_relationship():
     finally:
         if os.path.exists(db_path):
             os.unlink(db_path)
+
+
+def _create_legacy_schema(test_engine):
+    """Схема БД до появления keys.email и покрывающего индекса."""
+    from sqlalchemy import text
+
+    with test_engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE keys (id INTEGER PRIMARY KEY, uuid VARCHAR NOT NULL, "
+                "short_id VARCHAR(8) NOT NULL, name VARCHAR, "
+                "created_at BIGINT NOT NULL, is_active INTEGER, last_used_at BIGINT)"
+            )
+        )
+        conn.execute(
+            text(
+                "CREATE TABLE traffic_stats (id INTEGER PRIMARY KEY, "
+                "key_id INTEGER NOT NULL, upload BIGINT, download BIGINT, "
+                "updated_at BIGINT NOT NULL)"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO keys (id, uuid, short_id, created_at, is_active) "
+                "VALUES (7, '123e4567-e89b-12d3-a456-426614174000', 'abcd1234', 0, 1)"
+            )
+        )
+
+
+@pytest.fixture
+def legacy_engine(monkeypatch):
+    """Движок со старой схемой, подставленный в api.database."""
+    import api.database as db_module
+
+    db_fd, db_path = tempfile.mkstemp(suffix=".db")
+    os.close(db_fd)
+    test_engine = create_engine(
+        f"sqlite:///{db_path}", connect_args={"check_same_thread": False}
+    )
+    _create_legacy_schema(test_engine)
+    monkeypatch.setattr(db_module, "engine", test_engine)
+    yield test_engine
+    test_engine.dispose()
+    if os.path.exists(db_path):
+        os.unlink(db_path)
+
+
+def test_traffic_stats_covering_index(legacy_engine):
+    """init_db добавляет покрывающий индекс и в уже существующую таблицу."""
+    from sqlalchemy import inspect
+
+    init_db()
+
+    indexes = inspect(legacy_engine).get_indexes("traffic_stats")
+    covering = next(i for i in indexes if i["name"] == "idx_traffic_covering")
+    assert covering["column_names"] == ["key_id", "updated_at", "upload", "download"]
+
+
+def test_init_db_backfills_key_email(legacy_engine):
+    """init_db добавляет keys.email и заполняет его для существующих ключей."""
+    from sqlalchemy import text
+
+    from api.database import xray_email
+
+    init_db()
+
+    with legacy_engine.connect() as conn:
+        email = conn.execute(text("SELECT email FROM keys WHERE id = 7")).scalar()
+    assert email == xray_email(7, "123e4567-e89b-12d3-a456-426614174000")
+    assert email == "user_7_123e4567"
+
+
+def test_init_db_dedupes_traffic_stats(legacy_engine):
+    """init_db оставляет одну строку traffic_stats на ключ и создаёт UNIQUE(key_id)."""
+    from sqlalchemy import inspect, text
+
+    with legacy_engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO traffic_stats (id, key_id, upload, download, updated_at) "
+                "VALUES (1, 7, 1, 1, 1), (2, 7, 5, 6, 2)"
+            )
+        )
+
+    init_db()
+
+    with legacy_engine.connect() as conn:
+        rows = conn.execute(text("SELECT id, upload FROM traffic_stats")).all()
+    assert [tuple(r) for r in rows] == [(2, 5)]
+    unique = {
+        i["name"]
+        for i in inspect(legacy_engine).get_indexes("traffic_stats")
+        if i["unique"]
+    }
+    assert "uq_traffic_stats_key_id" in unique
+
+
+def test_init_db_skips_when_schema_current(legacy_engine, monkeypatch):
+    """Повторный init_db при актуальном PRAGMA user_version не вызывает create_all."""
+    from sqlalchemy import text
+
+    from api.database import SCHEMA_VERSION
+
+    init_db()
+    with legacy_engine.connect() as conn:
+        assert conn.execute(text("PRAGMA user_version")).scalar() == SCHEMA_VERSION
+
+    def fail_create_all(*args, **kwargs):
+        raise AssertionError("create_all must be skipped")
+
+    monkeypatch.setattr(Base.metadata, "create_all", fail_create_all)
+    init_db()
+
+
+def test_traffic_stats_fk_cascades_on_delete():
+    """traffic_stats.key_id создаётся с ON DELETE CASCADE."""
+    from sqlalchemy import inspect
+
+    test_engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=test_engine)
+
+    (fk,) = inspect(test_engine).get_foreign_keys("traffic_stats")
+    assert fk["referred_table"] == "keys"
+    assert fk["options"].get("ondelete") == "CASCADE"
+    test_engine.dispose()
@@ -26,3 +26,35 @@ def test_integrity_maps_to_409():
             integrity_conflict_detail="duplicate",
         )
     assert exc.value.status_code == status.HTTP_409_CONFLICT
+
+
+def test_read_endpoint_db_timeout_maps_to_503(client, auth_headers, monkeypatch):
+    """Ошибки БД в эндпоинтах без try/except обрабатывает глобальный handler."""
+    import api.main as main_module
+
+    def timeout(*args, **kwargs):
+        raise SATimeoutError("stmt", {}, None)
+
+    monkeypatch.setattr(main_module, "_load_key_row", timeout)
+    response = client.get("/api/keys/1", headers=auth_headers)
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert (
+        response.json()["detail"] == "Database temporarily unavailable. Please retry."
+    )
+
+
+def test_unhandled_exception_returns_json_500(test_db, auth_headers, monkeypatch):
+    """Непойманное исключение → 500 с телом {"detail": ...}, а не текст Starlette."""
+    from fastapi.testclient import TestClient
+
+    import api.main as main_module
+
+    def boom(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(main_module, "_load_key_row", boom)
+    # ServerErrorMiddleware пробрасывает исключение дальше после ответа
+    client = TestClient(main_module.app, raise_server_exceptions=False)
+    response = client.get("/api/keys/1", headers=auth_headers)
+    assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+    assert response.json() == {"detail": "Internal server error"}
@@ -142,3 +142,146 @@ async def test_config_task_post_init():
     assert task.task_type == TaskType.ADD_USER
     assert task.uuid == "test-uuid"
     assert task.short_id == "test1234"
+
+
+@pytest.mark.asyncio
+async def test_burst_tasks_coalesced_into_one_write(task_queue):
+    """Всплеск задач обрабатывается одной записью конфигурации."""
+    from unittest.mock import patch
+
+    with patch(
+        "api.xray_config.XrayConfigManager.apply_user_mutations", return_value=True
+    ) as mock_apply:
+        await task_queue.start()
+        try:
+            results = await asyncio.gather(
+                *(
+                    task_queue.execute_task_and_wait(
+                        task_type=TaskType.ADD_USER,
+                        uuid=f"uuid-{i}",
+                        short_id="test1234",
+                        email=f"user{i}@example.com",
+                        timeout=5.0,
+                    )
+                    for i in range(5)
+                )
+            )
+        finally:
+            await task_queue.stop()
+
+    assert results == [True] * 5
+    assert mock_apply.call_count == 1
+    mutations = mock_apply.call_args.args[0]
+    assert [m[1] for m in mutations] == [f"uuid-{i}" for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_config_manager_reused_across_batches(task_queue):
+    """Очередь создаёт XrayConfigManager один раз и переиспользует его."""
+    from unittest.mock import patch
+
+    with patch(
+        "api.xray_config.XrayConfigManager.add_user_to_config", return_value=True
+    ), patch("api.xray_config.XrayConfigManager.__init__", return_value=None) as init:
+        await task_queue.start()
+        try:
+            for i in range(3):
+                assert await task_queue.execute_task_and_wait(
+                    task_type=TaskType.ADD_USER,
+                    uuid=f"uuid-{i}",
+                    short_id="test1234",
+                    timeout=5.0,
+                )
+        finally:
+            await task_queue.stop()
+
+    assert init.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_sync_and_async_callbacks_invoked(task_queue):
+    """Sync callback вызывается, результат async callback дожидается воркер."""
+    from unittest.mock import patch
+
+    sync_results = []
+    async_results = []
+
+    async def async_callback(success):
+        async_results.append(success)
+
+    with patch(
+        "api.xray_config.XrayConfigManager.apply_user_mutations", return_value=True
+    ):
+        await task_queue.start()
+        try:
+            await task_queue.add_task(
+                TaskType.ADD_USER, "uuid-s", "test1234", callback=sync_results.append
+            )
+            await task_queue.add_task(
+                TaskType.ADD_USER, "uuid-a", "test1234", callback=async_callback
+            )
+            await task_queue._queue.join()
+        finally:
+            await task_queue.stop()
+
+    assert sync_results == [True]
+    assert async_results == [True]
+
+
+@pytest.mark.asyncio
+async def test_full_queue_applies_backpressure_within_timeout():
+    """Заполненная очередь задерживает add_task; ожидание входит в timeout."""
+    task_queue = ConfigTaskQueue(maxsize=1)
+    # Воркер не запущен: очередь не разгружается
+    task_queue._is_running = True
+    await task_queue.add_task(TaskType.ADD_USER, "uuid-first", "test1234")
+
+    with pytest.raises(asyncio.TimeoutError):
+        await task_queue.execute_task_and_wait(
+            task_type=TaskType.ADD_USER,
+            uuid="uuid-second",
+            short_id="test1234",
+            timeout=0.05,
+        )
+    assert task_queue.get_queue_size() == 1
+    assert task_queue._pending_futures == {}
+
+
+@pytest.mark.asyncio
+async def test_stop_with_full_queue_and_waiting_producers():
+    """stop() на заполненной очереди не зависает и завершает всех ожидающих."""
+    import time
+    from unittest.mock import patch
+
+    task_queue = ConfigTaskQueue(maxsize=2)
+
+    def slow_apply(mutations):
+        time.sleep(0.05)
+        return True
+
+    with patch(
+        "api.xray_config.XrayConfigManager.apply_user_mutations",
+        side_effect=slow_apply,
+    ):
+        await task_queue.start()
+        producers = [
+            asyncio.create_task(
+                task_queue.execute_task_and_wait(
+                    task_type=TaskType.ADD_USER,
+                    uuid=f"uuid-{i}",
+                    short_id="test1234",
+                    timeout=5.0,
+                )
+            )
+            for i in range(10)
+        ]
+        # Даём продюсерам заполнить очередь и встать в ожидание места
+        await asyncio.sleep(0.01)
+        assert task_queue._queue.full()
+
+        await asyncio.wait_for(task_queue.stop(), 2.0)
+        results = await asyncio.wait_for(asyncio.gather(*producers), 2.0)
+
+    assert all(isinstance(result, bool) for result in results)
+    assert task_queue._pending_futures == {}
+    assert task_queue.get_queue_size() == 0
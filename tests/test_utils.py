@@ -14,6 +14,15 @@ def test_generate_uuid():
     assert uuid1.count("-") == 4
 
 
+def test_generate_uuid_is_random_v4():
+    """UUID-учётные данные — случайный UUIDv4, без метки времени."""
+    import uuid as uuid_module
+
+    parsed = uuid_module.UUID(generate_uuid())
+    assert parsed.version == 4
+    assert parsed.variant == uuid_module.RFC_4122
+
+
 def test_generate_short_id():
     """Тест генерации Short ID"""
     short_id1 = generate_short_id(8)
@@ -81,3 +90,66 @@ def test_generate_reality_keys():
             base64.urlsafe_b64decode(padded)
     except Exception:
         pytest.fail("Keys are not valid base64")
+
+
+def test_normalize_reality_public_key_cached():
+    """Стандартный base64 → URL-safe без padding; повтор берётся из кэша."""
+    from api.utils import normalize_reality_public_key
+
+    import base64
+
+    normalize_reality_public_key.cache_clear()
+    raw = base64.b64encode(bytes(range(250, 256)) + bytes(26)).decode()
+    expected = base64.urlsafe_b64encode(base64.b64decode(raw)).decode().rstrip("=")
+    assert "+" in raw or "/" in raw
+    assert normalize_reality_public_key(raw) == expected
+    assert normalize_reality_public_key(raw) == expected
+    assert normalize_reality_public_key.cache_info().hits == 1
+    assert normalize_reality_public_key("already-url_safe") == "already-url_safe"
+
+
+def test_parse_key_identifier():
+    """UUID и положительный key_id распознаются, прочее — ValueError."""
+    from api.utils import parse_key_identifier
+
+    uuid_value = "123e4567-e89b-12d3-a456-426614174000"
+    assert parse_key_identifier(uuid_value) == (uuid_value, None, True)
+    assert parse_key_identifier("42") == (None, 42, False)
+    assert parse_key_identifier(uuid_value.upper())[2] is True
+    for bad in ("not-a-uuid", "0", "00", "abc", "-5", "²"):
+        with pytest.raises(ValueError):
+            parse_key_identifier(bad)
+
+
+def test_build_vless_link_escapes_remark_and_path():
+    """Пробелы, # и не-ASCII в имени профиля экранируются; path сохраняет '/'."""
+    from api.utils import build_vless_link_with_transport
+
+    link = build_vless_link_with_transport(
+        uuid="u",
+        short_id="abcd1234",
+        server_address="vpn.example.com",
+        port=8445,
+        sni="microsoft.com",
+        fingerprint="chrome",
+        public_key="pbk-_x",
+        transport="xhttp",
+        path="/a b",
+        remark="Мой VPN #1",
+    )
+    query, fragment = link.split("?", 1)[1].split("#")
+    assert "path=/a%20b" in query
+    assert "pbk=pbk-_x" in query
+    assert fragment == "%D0%9C%D0%BE%D0%B9%20VPN%20%231"
+
+    plain = build_vless_link(
+        uuid="u",
+        short_id="abcd1234",
+        server_address="vpn.example.com",
+        port=443,
+        sni="microsoft.com",
+        fingerprint="chrome",
+        public_key="pbk",
+        dest="www.microsoft.com:443",
+    )
+    assert plain.endswith("#www.microsoft.com:443")
@@ -210,3 +210,79 @@ async def test_reset_user_stats_failure(xray_client):
         )
         result = await xray_client.reset_user_stats("user_1_abc12345")
         assert result is False
+
+
+@pytest.mark.asyncio
+async def test_health_check_shared_between_calls(xray_client):
+    """Успешная проверка доступности переиспользуется последующими add/remove."""
+    with patch("api.xray_client.subprocess.run") as mock_run:
+        with patch.object(xray_client, "check_health", return_value=True) as health:
+            mock_result = MagicMock()
+            mock_result.returncode = 0
+            mock_result.stderr = ""
+            mock_result.stdout = ""
+            mock_run.return_value = mock_result
+
+            assert await xray_client.add_user("uuid-1", "a@example.com") is True
+            assert await xray_client.add_user("uuid-2", "b@example.com") is True
+            assert await xray_client.remove_user("a@example.com") is True
+            assert health.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_health_check_not_cached(xray_client):
+    """Неудачная проверка не кэшируется: следующий вызов проверяет снова."""
+    with patch.object(xray_client, "check_health", return_value=False) as health:
+        assert await xray_client.add_user("uuid-1", "a@example.com") is False
+        assert await xray_client.add_user("uuid-1", "a@example.com") is False
+        assert health.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_all_user_stats_parses_single_query(xray_client):
+    """Один statsquery по user>>> разбирается в словарь по email."""
+    stdout = (
+        '{"stat": ['
+        '{"name": "user>>>a@x>>>traffic>>>uplink", "value": 10},'
+        '{"name": "user>>>a@x>>>traffic>>>downlink", "value": 20},'
+        '{"name": "user>>>b@x>>>traffic>>>downlink", "value": 5},'
+        '{"name": "inbound>>>vless>>>traffic>>>uplink", "value": 99}'
+        "]}"
+    ).encode()
+    with patch("api.xray_client.subprocess.run") as mock_run:
+        mock_run.return_value = MagicMock(returncode=0, stdout=stdout, stderr=b"")
+        stats = await xray_client.get_all_user_stats()
+
+    assert mock_run.call_count == 1
+    # Вывод читается байтами и разбирается orjson без декодирования в str
+    assert mock_run.call_args.kwargs["text"] is False
+    assert mock_run.call_args.args[0][-2:] == ["--pattern", "user>>>"]
+    assert stats == {
+        "a@x": {"upload": 10, "download": 20},
+        "b@x": {"upload": 0, "download": 5},
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_all_user_stats_failure_returns_none(xray_client):
+    """Ошибка statsquery — None, а не пустая статистика."""
+    with patch("api.xray_client.subprocess.run") as mock_run:
+        mock_run.return_value = MagicMock(returncode=1, stdout="", stderr="down")
+        assert await xray_client.get_all_user_stats() is None
+
+
+@pytest.mark.asyncio
+async def test_get_user_stats_ignores_other_users(xray_client):
+    """Счётчики другого пользователя с похожим email не суммируются."""
+    with patch.object(xray_client, "get_stats") as mock_get_stats:
+        mock_get_stats.return_value = {
+            "stat": [
+                {"name": "user>>>user_1_a>>>traffic>>>uplink", "value": 10},
+                {"name": "user>>>user_1_a>>>traffic>>>downlink", "value": 20},
+                {"name": "user>>>user_11_a>>>traffic>>>uplink", "value": 99},
+                {"name": "inbound>>>user_1_a>>>traffic>>>uplink", "value": 99},
+            ]
+        }
+
+        result = await xray_client.get_user_stats("user_1_a")
+        assert result == {"upload": 10, "download": 20}
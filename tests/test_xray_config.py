@@ -292,3 +292,67 @@ def test_bulk_sync_vless_clients(config_manager, sample_config):
     assert result["saved"] is True
     assert result["added"] == 2
     assert mock_save.call_count == 1
+
+
+def test_bulk_sync_vless_clients_skips_write_when_up_to_date(config_manager):
+    """Повторная синхронизация тех же пользователей не перезаписывает config.json."""
+    users = [("uuid-a", "a@x"), ("uuid-b", "b@x")]
+    assert config_manager.bulk_sync_vless_clients(users, validate=False, test=False)[
+        "saved"
+    ]
+
+    with patch.object(config_manager, "save_config") as mock_save:
+        result = config_manager.bulk_sync_vless_clients(
+            users, validate=False, test=False
+        )
+    assert mock_save.call_count == 0
+    assert result["saved"] is True
+    assert result["added"] == 0
+    assert result["already_present"] == 2
+
+
+def test_apply_user_mutations_single_save(config_manager):
+    """Пачка add/remove применяется по порядку и сохраняется одним save_config."""
+    mutations = [
+        ("add", "uuid-a", "a@x"),
+        ("add", "uuid-b", "b@x"),
+        ("remove", "uuid-a", None),
+    ]
+    with patch.object(
+        config_manager, "save_config", wraps=config_manager.save_config
+    ) as mock_save:
+        assert config_manager.apply_user_mutations(
+            mutations, validate=False, test=False
+        )
+    assert mock_save.call_count == 1
+
+    config = config_manager.load_config()
+    for tag in settings.vless_inbound_tags():
+        inbound = next(i for i in config["inbounds"] if i["tag"] == tag)
+        assert [c["id"] for c in inbound["settings"]["clients"]] == ["uuid-b"]
+    assert not os.path.exists(config_manager.config_path + ".tmp")
+
+
+def test_concurrent_add_user_keeps_all_clients(config_manager):
+    """Параллельные add_user_to_config под flock не теряют клиентов."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    uuids = [f"uuid-{i}" for i in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(
+            pool.map(
+                lambda u: config_manager.add_user_to_config(
+                    uuid=u, short_id="abcd1234", email=f"{u}@x"
+                ),
+                uuids,
+            )
+        )
+    assert all(results)
+
+    config = config_manager.load_config()
+    inbound = next(
+        i
+        for i in config["inbounds"]
+        if i["tag"] == settings.xray_vless_reality_inbound_tag
+    )
+    assert {c["id"] for c in inbound["settings"]["clients"]} >= set(uuids)